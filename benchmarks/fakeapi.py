@@ -0,0 +1,76 @@
+# benchmarks/fakeapi.py
+"""
+In-process stand-in for the Telegram Bot API. Plugged into the real Bot as
+its request backend, it records every call, adds configurable latency and
+answers a configurable share of sends with 429 Too Many Requests.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+# Methods that deliver a message and are therefore subject to flood limits.
+SEND_METHODS = {'sendMessage', 'sendPhoto', 'copyMessage', 'editMessageText', 'sendDocument'}
+
+
+class FakeBotAPI(BaseRequest):
+    def __init__(self, latency=0.05, jitter=0.02, retry_after_rate=0.0, retry_after=1, bot_username='benchbot'):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.bot_username = bot_username
+        self.calls = Counter()
+        self.rejected = Counter()
+        self.sent_at = []  # monotonic timestamps of successful sends
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def reset(self):
+        self.calls.clear()
+        self.rejected.clear()
+        self.sent_at.clear()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        self.calls[endpoint] += 1
+        if endpoint in SEND_METHODS and self.retry_after_rate and random.random() < self.retry_after_rate:
+            self.rejected[endpoint] += 1
+            return 429, json.dumps({
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }).encode()
+        if endpoint in SEND_METHODS:
+            self.sent_at.append(time.monotonic())
+        return 200, json.dumps({'ok': True, 'result': self._result(endpoint, params)}).encode()
+
+    def _result(self, endpoint, params):
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': self.bot_username,
+                    'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        if endpoint == 'getChatMember':
+            return {'status': 'member', 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'member'}}
+        if endpoint == 'copyMessage':
+            return {'message_id': next(self._message_ids)}
+        if endpoint in ('answerCallbackQuery', 'deleteMessage', 'setWebhook', 'deleteWebhook'):
+            return True
+        chat_id = int(params.get('chat_id', 0) or 0)
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
@@ -0,0 +1,239 @@
+# benchmarks/run.py
+"""
+Offline load test for the bot. Drives the real Application and handlers with
+synthetic updates through the fake Bot API in benchmarks/fakeapi.py and a
+local Postgres, then reports latency percentiles, throughput, CPU time and
+DB queries and API calls per update.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python -m benchmarks.run
+    python -m benchmarks.run --scenario registration --users 2000 --concurrency 64 --retry-after-rate 0.01
+
+Everything runs inside the `bench` schema (recreated on every run), so the
+database can be shared with a development bot.
+
+The Application goes through the same startup as production (post_init and
+start), and queued notifications (bot.notify) are drained and persistence is
+written before a scenario's counts are taken, so their API calls and queries
+land in the scenario that caused them. The per-chat
+send interval defaults to 0.05s here so the registration burst's referral
+notices to the one influencer drain in seconds; set BOT_API_PER_CHAT_INTERVAL=1
+to see the production backlog.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import statistics
+import time
+
+os.environ.setdefault('ADMIN_TELEGRAM_ID', '1')
+os.environ.setdefault('FORCE_JOIN_CHANNEL', '@bench_channel')
+os.environ.setdefault('PHONE_HASH_KEY', 'bench')
+os.environ.setdefault('BOT_API_PER_CHAT_INTERVAL', '0.05')
+os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL', os.environ.get('DATABASE_URL', ''))
+
+import psycopg2.extensions  # noqa: E402
+from telegram import Update  # noqa: E402
+
+import main  # noqa: E402
+from bot import broadcast, database as db, handlers, lifecycle, notify  # noqa: E402
+
+from .fakeapi import FakeBotAPI  # noqa: E402
+
+SCHEMA = 'bench'
+ADMIN_ID = handlers.ADMIN_ID
+INFLUENCER_ID = 2
+FIRST_USER_ID = 10_000_000
+MENU_BUTTONS = ['my_balance', 'refer_friends', 'my_referrals', 'top_referrers', 'statistics', 'help_support', 'main_menu']
+STATIC_BUTTONS = ['refer_friends', 'help_support', 'main_menu']  # screens that need no database work
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    queries = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.queries += 1
+        return super().execute(query, vars)
+
+
+# --- Synthetic updates ---
+_ids = itertools.count(1)
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'}
+
+def message(user_id, text=None, contact=None):
+    msg = {'message_id': next(_ids), 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': _user(user_id)}
+    if text is not None:
+        msg['text'] = text
+        if text.startswith('/'):
+            msg['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    if contact:
+        msg['contact'] = {'phone_number': contact, 'first_name': 'user', 'user_id': user_id}
+    return {'update_id': next(_ids), 'message': msg}
+
+def callback(user_id, data):
+    return {'update_id': next(_ids), 'callback_query': {
+        'id': str(next(_ids)), 'chat_instance': 'bench', 'from': _user(user_id), 'data': data,
+        'message': {'message_id': next(_ids), 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench'}, 'text': 'menu'},
+    }}
+
+
+# --- Driver ---
+class Bench:
+    def __init__(self, application, api, concurrency):
+        self.application = application
+        self.api = api
+        self.concurrency = concurrency
+        self.latencies = []
+
+    async def feed(self, raw):
+        """Process one update through the Application's update processor, timing queueing and handling."""
+        update = Update.de_json(raw, self.application.bot)
+        started = time.perf_counter()
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+        self.latencies.append(time.perf_counter() - started)
+
+    async def run_sessions(self, sessions):
+        """Run each session (a list of raw updates for one user, in order) with bounded concurrency across users."""
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def session(updates):
+            async with slots:
+                for raw in updates:
+                    await self.feed(raw)
+
+        await asyncio.gather(*(session(updates) for updates in sessions))
+
+    async def measure(self, name, coro):
+        self.latencies.clear()
+        self.api.reset()
+        queries_before = CountingCursor.queries
+        started, cpu_started = time.perf_counter(), time.process_time()
+        await coro
+        elapsed = time.perf_counter() - started
+        if notify._queue is not None:
+            await notify._drain()
+        drained = time.perf_counter() - started - elapsed
+        # Persist now rather than on the next interval so the scenario pays for its own writes.
+        await self.application.update_persistence()
+        await self.application.persistence.flush()
+        cpu = time.process_time() - cpu_started
+        report(name, self.latencies, elapsed, cpu, CountingCursor.queries - queries_before, self.api)
+        if drained >= 0.01:
+            print(f"notifications drained {drained:.2f}s after the last update")
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def report(name, latencies, elapsed, cpu, queries, api):
+    updates = len(latencies)
+    print(f"\n== {name} ==")
+    if updates:
+        print(f"updates: {updates}  wall: {elapsed:.2f}s  throughput: {updates / elapsed:.1f} updates/s")
+        print(f"latency ms  p50: {_percentile(latencies, 50) * 1000:.1f}  p95: {_percentile(latencies, 95) * 1000:.1f}  "
+              f"p99: {_percentile(latencies, 99) * 1000:.1f}  mean: {statistics.mean(latencies) * 1000:.1f}")
+        print(f"cpu ms/update: {cpu / updates * 1000:.3f}  db queries/update: {queries / updates:.2f}  "
+              f"api calls/update: {sum(api.calls.values()) / updates:.2f}")
+    else:
+        print(f"wall: {elapsed:.2f}s  db queries: {queries}")
+    print(f"api calls: {dict(api.calls)}" + (f"  429s: {dict(api.rejected)}" if api.rejected else ""))
+
+
+# --- Scenarios ---
+async def seed_users(count, balance=0):
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + count))
+    for user_id in user_ids:
+        await db.add_user(user_id, f'user{user_id}', None)
+        if balance:
+            await db.update_balance(user_id, balance)
+    return user_ids
+
+async def scenario_registration(bench, args):
+    """A referral burst: every new user opens the influencer's link and shares their contact."""
+    start = FIRST_USER_ID + 5_000_000
+    sessions = [[message(user_id, f'/start {INFLUENCER_ID}'), message(user_id, contact=f'+2519{user_id:08d}')]
+                for user_id in range(start, start + args.users)]
+    await bench.measure("registration burst (contact_handler)", bench.run_sessions(sessions))
+
+async def scenario_menu(bench, args, user_ids):
+    sessions = [[callback(user_id, random.choice(MENU_BUTTONS)) for _ in range(args.presses)] for user_id in user_ids]
+    await bench.measure("menu browsing (button_handler)", bench.run_sessions(sessions))
+
+async def scenario_screens(bench, args, user_ids):
+    sessions = [[callback(user_id, random.choice(STATIC_BUTTONS)) for _ in range(args.presses)] for user_id in user_ids]
+    await bench.measure("static screens (refer, help, menu)", bench.run_sessions(sessions))
+
+async def scenario_withdrawal(bench, args, user_ids):
+    sessions = [[callback(user_id, 'withdraw'), callback(user_id, 'withdraw_telebirr'),
+                 message(user_id, '0911000000'), message(user_id, str(handlers.MIN_WITHDRAWAL))] for user_id in user_ids]
+    await bench.measure("withdrawal conversation", bench.run_sessions(sessions))
+
+async def scenario_broadcast(bench, args):
+    async def run():
+        await bench.run_sessions([[callback(ADMIN_ID, 'admin_broadcast'), message(ADMIN_ID, 'Hello everyone!'), message(ADMIN_ID, 'YES')]])
+        while broadcast._tasks:
+            await asyncio.gather(*broadcast._tasks.values())
+    await bench.measure("broadcast (admin flow + delivery)", run())
+    sent = sorted(bench.api.sent_at)
+    if len(sent) > 1:
+        print(f"broadcast delivery rate: {len(sent) / (sent[-1] - sent[0]):.1f} msg/s")
+
+
+def reset_schema():
+    with db._connection() as conn, conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}")
+    db.setup_database()
+
+
+async def run(args):
+    api = FakeBotAPI(latency=args.latency, jitter=args.latency / 3, retry_after_rate=args.retry_after_rate)
+    application = main.build_application('1:bench')
+    application.bot._request = (api, api)  # both the getUpdates and the general request slots
+    async with lifecycle.running(application):  # post_init/start as in production: phone filter, jobs, persistence
+        await db.add_user(ADMIN_ID, 'admin', None)
+        await db.add_user(INFLUENCER_ID, 'influencer', None)
+        bench = Bench(application, api, args.concurrency)
+        scenarios = set(args.scenario or ['registration', 'menu', 'screens', 'withdrawal', 'broadcast'])
+        if 'registration' in scenarios:
+            await scenario_registration(bench, args)
+        user_ids = await seed_users(args.users, balance=handlers.MIN_WITHDRAWAL * 2)
+        if 'menu' in scenarios:
+            await scenario_menu(bench, args, user_ids)
+        if 'screens' in scenarios:
+            await scenario_screens(bench, args, user_ids)
+        if 'withdrawal' in scenarios:
+            await scenario_withdrawal(bench, args, user_ids)
+        if 'broadcast' in scenarios:
+            await scenario_broadcast(bench, args)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline load test for the bot's handlers.")
+    parser.add_argument('--scenario', action='append', choices=('registration', 'menu', 'screens', 'withdrawal', 'broadcast'),
+                        help="scenario to run; repeat for several (default: all)")
+    parser.add_argument('--users', type=int, default=500, help="simulated users per scenario")
+    parser.add_argument('--presses', type=int, default=5, help="menu presses per user in the menu scenario")
+    parser.add_argument('--concurrency', type=int, default=50, help="users active at the same time")
+    parser.add_argument('--latency', type=float, default=0.05, help="mean fake Bot API latency in seconds")
+    parser.add_argument('--retry-after-rate', type=float, default=0.0, help="share of sends answered with 429 RetryAfter")
+    args = parser.parse_args()
+    if not os.environ['DATABASE_URL']:
+        parser.error("set BENCH_DATABASE_URL (or DATABASE_URL) to a local Postgres")
+
+    logging.getLogger().setLevel(logging.WARNING)
+    db.init_pool(cursor_factory=CountingCursor, options=f'-c search_path={SCHEMA}')
+    reset_schema()
+    try:
+        asyncio.run(run(args))
+    finally:
+        db.close_pool()
+
+
+if __name__ == '__main__':
+    main_cli()
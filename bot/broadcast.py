@@ -0,0 +1,149 @@
+# bot/broadcast.py
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from . import database as db
+from .ratelimit import bot_limiter, broadcast_limiter, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = int(os.environ.get('BROADCAST_CHUNK_SIZE', 100))
+CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', 20))
+MAX_ATTEMPTS = 3
+PROGRESS_INTERVAL = 10  # seconds between progress edits sent to the admin
+# A running broadcast is leased to one process and the lease is renewed on a
+# timer, however long a chunk takes; if the process dies, another one claims it
+# once the lease lapses.
+LEASE_SECONDS = int(os.environ.get('BROADCAST_LEASE', 60))
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+_tasks = {}  # broadcast id -> task
+
+
+async def start(bot, admin_chat_id, from_chat_id, message_id):
+    """Record a new broadcast and start delivering it in the background."""
+    broadcast_id = await db.create_broadcast(from_chat_id, message_id, admin_chat_id, OWNER, LEASE_SECONDS)
+    _spawn(bot, (broadcast_id, from_chat_id, message_id, admin_chat_id, 0, 0, 0))
+    return broadcast_id
+
+
+async def resume_unfinished(bot):
+    """Claim broadcasts no process is running (stopped, crashed or released) and resume them."""
+    for row in await db.claim_broadcasts(OWNER, LEASE_SECONDS):
+        if row[0] in _tasks:
+            continue  # ours, just slow enough to let the lease lapse
+        logger.info(f"Resuming broadcast #{row[0]} after user {row[4]}")
+        _spawn(bot, row)
+
+
+async def claim_job(context):
+    try:
+        await resume_unfinished(context.bot)
+    except Exception:
+        logger.exception("Could not claim unfinished broadcasts")
+
+
+async def stop_all():
+    """Cancel running deliveries; they stay 'running' in the DB and resume wherever they are claimed next."""
+    for task in list(_tasks.values()):
+        task.cancel()
+    await asyncio.gather(*_tasks.values(), return_exceptions=True)
+    await db.release_broadcasts(OWNER)
+
+
+def _spawn(bot, row):
+    broadcast_id = row[0]
+    task = asyncio.create_task(_run(bot, *row))
+    _tasks[broadcast_id] = task
+    task.add_done_callback(lambda _: _tasks.pop(broadcast_id, None))
+
+
+async def _send(bot, chat_id, from_chat_id, message_id):
+    attempt = 0
+    while attempt < MAX_ATTEMPTS:
+        await broadcast_limiter.wait(chat_id)
+        try:
+            await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
+            return True
+        except RetryAfter as e:
+            # Flood control isn't the recipient's fault; wait it out without spending an attempt.
+            # It applies to the whole bot, so notifications back off too.
+            for limiter in {broadcast_limiter, bot_limiter}:
+                limiter.retry_after(retry_after_seconds(e))
+        except (Forbidden, BadRequest):
+            return False  # blocked the bot, deleted account, etc.
+        except NetworkError:
+            await asyncio.sleep(2 ** attempt)
+            attempt += 1
+        except TelegramError as e:
+            logger.warning(f"Broadcast to {chat_id} failed: {e}")
+            return False
+    return False
+
+
+async def _hold_lease(broadcast_id, delivery):
+    """Renew the lease until cancelled; stop `delivery` if another process has claimed the broadcast."""
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        try:
+            if await db.renew_broadcast_lease(broadcast_id, OWNER, LEASE_SECONDS):
+                continue
+        except Exception:
+            logger.exception(f"Could not renew the lease on broadcast #{broadcast_id}")
+            continue
+        logger.warning(f"Broadcast #{broadcast_id} was claimed by another process; stopping here")
+        delivery.cancel()
+        return
+
+
+async def _run(bot, broadcast_id, from_chat_id, message_id, admin_chat_id, cursor, sent, failed):
+    status_message = None
+    started, reported = time.monotonic(), 0.0
+    sent_at_start = sent + failed
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def deliver(user_id):
+        async with semaphore:
+            return await _send(bot, user_id, from_chat_id, message_id)
+
+    async def report(final=False):
+        nonlocal status_message, reported
+        reported = time.monotonic()
+        rate = (sent + failed - sent_at_start) / max(reported - started, 1e-6)
+        text = (f"📢 Broadcast #{broadcast_id} {'complete' if final else 'in progress'}\n\n"
+                f"Sent: {sent}\nFailed: {failed}\nRate: {rate:.1f} msg/s")
+        try:
+            if status_message: await status_message.edit_text(text)
+            else: status_message = await bot.send_message(chat_id=admin_chat_id, text=text)
+        except TelegramError as e:
+            logger.warning(f"Could not update broadcast #{broadcast_id} progress: {e}")
+
+    lease = asyncio.create_task(_hold_lease(broadcast_id, asyncio.current_task()))
+    try:
+        await report()
+        while True:
+            user_ids = await db.get_broadcast_recipients(cursor, CHUNK_SIZE)
+            if not user_ids:
+                break
+            results = await asyncio.gather(*(deliver(user_id) for user_id in user_ids))
+            cursor = user_ids[-1]
+            if not await db.record_broadcast_progress(broadcast_id, list(zip(user_ids, results)), cursor, OWNER, LEASE_SECONDS):
+                logger.warning(f"Broadcast #{broadcast_id} was claimed by another process; stopping here")
+                return
+            delivered = sum(results)
+            sent, failed = sent + delivered, failed + len(results) - delivered
+            if time.monotonic() - reported >= PROGRESS_INTERVAL:
+                await report()
+        await db.finish_broadcast(broadcast_id)
+        await report(final=True)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception(f"Broadcast #{broadcast_id} stopped; it will resume on next start")
+    finally:
+        lease.cancel()
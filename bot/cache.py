@@ -0,0 +1,73 @@
+# bot/cache.py
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire after `ttl` seconds. Used from
+    the event loop only, so it needs no locking.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # bumped on every invalidation, see `set(..., generation=)`
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, generation=None):
+        """
+        Store `value`. Pass the `generation` read before fetching it from the
+        database and the write is dropped if anything was invalidated since,
+        so a slow read can't overwrite a newer value.
+        """
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def update(self, key, value):
+        """Replace a value after a write we performed ourselves."""
+        self.generation += 1
+        self.set(key, value)
+
+    def adjust(self, key, delta):
+        """Add `delta` to a cached number after a write we performed; an uncached key stays uncached."""
+        self.generation += 1
+        entry = self._data.get(key)
+        if entry is not None and entry[0] >= time.monotonic():
+            self._data[key] = (entry[0], entry[1] + delta)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,88 @@
+# bot/concurrency.py
+import asyncio
+import os
+
+from telegram.ext import BaseUpdateProcessor
+
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 32))
+_UNBOUNDED = 1 << 30  # size of the base class semaphore; see PerUserUpdateProcessor
+
+
+def ordering_key(update):
+    """Updates sharing a key are processed one at a time, in arrival order."""
+    if update.effective_user:
+        return ('user', update.effective_user.id)
+    if update.effective_chat:
+        return ('chat', update.effective_chat.id)
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates from different users concurrently (up to `max_concurrent_updates`)
+    while serialising each user's updates, so ConversationHandler flows still see
+    them in order. A user's queued updates wait on their own lock before taking a
+    worker slot, so one busy user can't occupy the whole pool.
+
+    BaseUpdateProcessor.process_update is final and takes its semaphore before
+    do_process_update runs, which would let waiting updates hold slots. So the
+    base semaphore is left effectively unbounded and the real limit is a second
+    semaphore taken inside do_process_update, after the per-user lock.
+    """
+
+    def __init__(self, max_concurrent_updates=UPDATE_CONCURRENCY):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        super().__init__(_UNBOUNDED)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._keys = {}  # key -> [lock, number of updates holding or waiting for it]
+        self.in_flight = 0
+        self.pending = 0
+        self.max_pending = 0
+        self.processed = 0
+
+    async def do_process_update(self, update, coroutine):
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        key = ordering_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._keys.get(key)
+        if entry is None:
+            entry = self._keys[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._keys[key]
+
+    async def _run(self, coroutine):
+        async with self._slots:
+            self.pending -= 1
+            self.in_flight += 1
+            try:
+                await coroutine
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'processed': self.processed,
+            'active_users': len(self._keys),
+            'max_concurrency': self.limit,
+        }
@@ -1,148 +1,740 @@
 # bot/database.py
-import psycopg2
+import asyncio
+import functools
+import logging
 import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, extras, pool
 from dotenv import load_dotenv
 
+from . import migrations
+from .cache import MISSING, TTLCache
+
 load_dotenv()
 
-def get_connection():
-    return psycopg2.connect(os.environ.get('DATABASE_URL'))
+logger = logging.getLogger(__name__)
 
-def setup_database():
+# --- Connection Pool ---
+# psycopg2 is blocking, so every query runs on a small dedicated thread pool
+# sized to the connection pool. Handlers simply `await` the functions below.
+POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 2))
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', 10))
+CACHE_SIZE = int(os.environ.get('DB_CACHE_SIZE', 100000))
+CACHE_TTL = float(os.environ.get('DB_CACHE_TTL', 60))
+IDLE_CHECK_AFTER = float(os.environ.get('DB_IDLE_CHECK_AFTER', 30))  # ping connections idle longer than this
+
+_pool = None
+_executor = None
+_slots = None
+_lock = threading.Lock()
+_waiting = 0  # coroutines waiting for a connection
+_in_use = 0   # connections currently running a query
+_returned_at = {}  # pooled connection -> monotonic time it was last put back
+# Set by bot.metrics to observe(query_name, seconds, failed); None keeps the hot path free of timing.
+_observer = None
+
+
+# Read-through caches for the hottest lookups; every write below keeps them current.
+_user_cache = TTLCache(CACHE_SIZE, CACHE_TTL)     # user_id -> exists
+_balance_cache = TTLCache(CACHE_SIZE, CACHE_TTL)  # user_id -> balance
+
+
+class PoolTimeout(Exception):
+    """Raised when no database connection became free within ACQUIRE_TIMEOUT."""
+
+
+def init_pool(minconn=POOL_MIN_SIZE, maxconn=POOL_MAX_SIZE, **connect_kwargs):
+    """Open the shared connection pool. Safe to call more than once."""
+    global _pool, _executor
+    with _lock:
+        if _pool is None:
+            _pool = pool.ThreadedConnectionPool(minconn, maxconn, os.environ.get('DATABASE_URL'), **connect_kwargs)
+            _executor = ThreadPoolExecutor(max_workers=maxconn, thread_name_prefix='db')
+    return _pool
+
+
+def close_pool():
+    global _pool, _executor, _slots
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+        if _pool is not None:
+            _pool.closeall()
+        _returned_at.clear()
+        _pool, _executor, _slots = None, None, None
+
+
+def _healthy(conn):
+    if conn.closed:
+        return False
+    if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE:
+        # A server restart or a proxy's idle timeout drops the socket without
+        # changing the client-side status, so probe connections that sat idle.
+        returned_at = _returned_at.get(conn)
+        if returned_at is None or time.monotonic() - returned_at < IDLE_CHECK_AFTER:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    # A connection left mid-transaction or in an unknown state is not reusable.
+    try:
+        conn.rollback()
+        return conn.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def _connection():
+    """Check a healthy connection out of the pool for one transaction."""
+    db_pool = _pool or init_pool()
+    conn = db_pool.getconn()
+    # After a server restart every idle connection is dead; discard them until a
+    # live one (or a freshly opened one) turns up.
+    for _ in range(db_pool.maxconn):
+        if _healthy(conn):
+            break
+        _returned_at.pop(conn, None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    broken = False
+    try:
+        with conn:
+            yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if broken or conn.closed:
+            _returned_at.pop(conn, None)
+            db_pool.putconn(conn, close=True)
+        else:
+            _returned_at[conn] = time.monotonic()
+            db_pool.putconn(conn)
+
+
+def _query(fn):
     """
-    Create or update tables using idempotent methods. This can be run safely
-    on every bot startup without causing errors.
-    """
-    conn = get_connection()
-    with conn.cursor() as cur:
-        # Create users table if it doesn't exist
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id BIGINT PRIMARY KEY,
-            username VARCHAR(255),
-            phone_number VARCHAR(20),
-            referred_by BIGINT,
-            balance INT DEFAULT 0,
-            joined_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-        );
-        """)
-        
-        # Safely add the ip_address column if it's missing
-        cur.execute("""
-        DO $$
-        BEGIN
-            BEGIN
-                ALTER TABLE users ADD COLUMN ip_address VARCHAR(45);
-            EXCEPTION
-                WHEN duplicate_column THEN -- do nothing if column already exists
-            END;
-        END;
-        $$;
-        """)
-        
-        # Create other tables
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS referrals (
-            id SERIAL PRIMARY KEY,
-            referrer_id BIGINT REFERENCES users(id),
-            referred_id BIGINT REFERENCES users(id),
-            timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-        );
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS withdrawals (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT REFERENCES users(id),
-            method VARCHAR(50),
-            details VARCHAR(255),
-            amount INT,
-            status VARCHAR(20) DEFAULT 'pending',
-            requested_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-        );
-        """)
-    conn.commit()
-    conn.close()
-    
-# ... (The rest of the database.py file remains the same as the previous "Full Code" version)
-# You only need to replace the setup_database function, but replacing the whole file is safest.
+    Turn a blocking `fn(cur, *args)` into a coroutine that runs it on a pooled
+    connection inside a single transaction, off the event loop.
+    """
+    def call(*args, **kwargs):
+        with _connection() as conn, conn.cursor() as cur:
+            return fn(cur, *args, **kwargs)
+
+    name = fn.__name__.lstrip('_')
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        global _slots, _waiting, _in_use
+        if _pool is None:
+            init_pool()
+        if _slots is None:
+            _slots = asyncio.Semaphore(_pool.maxconn)
+        observer = _observer
+        started = time.perf_counter() if observer else 0.0
+        failed = True
+        _waiting += 1
+        try:
+            await asyncio.wait_for(_slots.acquire(), ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            if observer:
+                observer(name, time.perf_counter() - started, True)
+            raise PoolTimeout(f"No database connection available after {ACQUIRE_TIMEOUT}s") from None
+        finally:
+            _waiting -= 1
+        _in_use += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(_executor, functools.partial(call, *args, **kwargs))
+            failed = False
+            return result
+        finally:
+            _in_use -= 1
+            _slots.release()
+            if observer:
+                observer(name, time.perf_counter() - started, failed)
+    return wrapper
+
+
+def pool_stats():
+    return {'max': _pool.maxconn if _pool else POOL_MAX_SIZE, 'in_use': _in_use, 'waiting': _waiting}
+
+
+def setup_database():
+    """Bring the schema up to date. Does no DDL when it is already current."""
+    db_pool = _pool or init_pool()
+    conn = db_pool.getconn()
+    try:
+        applied = migrations.migrate(conn)
+        if applied:
+            logger.info(f"Applied {applied} migration(s); schema is at version {migrations.LATEST_VERSION}")
+    finally:
+        conn.autocommit = False
+        db_pool.putconn(conn)
 
 # --- User Functions ---
-def user_exists(user_id):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT id FROM users WHERE id = %s", (user_id,))
-        return cur.fetchone() is not None
-
-def add_user(user_id, username, phone_number, ip_address=None, referrer_id=None):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute(
-            "INSERT INTO users (id, username, phone_number, ip_address, referred_by) VALUES (%s, %s, %s, %s, %s)",
-            (user_id, username, phone_number, ip_address, referrer_id)
+@_query
+def _user_exists(cur, user_id):
+    cur.execute("SELECT id FROM users WHERE id = %s", (user_id,))
+    return cur.fetchone() is not None
+
+async def user_exists(user_id):
+    exists = _user_cache.get(user_id)
+    if exists is MISSING:
+        generation = _user_cache.generation
+        exists = await _user_exists(user_id)
+        _user_cache.set(user_id, exists, generation)
+    return exists
+
+@_query
+def _add_user(cur, user_id, username, phone_number, ip_address=None, referrer_id=None):
+    cur.execute(
+        "INSERT INTO users (id, username, phone_number, ip_address, referred_by) VALUES (%s, %s, %s, %s, %s)",
+        (user_id, username, phone_number, ip_address, referrer_id)
+    )
+
+async def add_user(user_id, username, phone_number, ip_address=None, referrer_id=None):
+    await _add_user(user_id, username, phone_number, ip_address, referrer_id)
+    _user_cache.update(user_id, True)
+    _balance_cache.update(user_id, 0)
+
+# Credits are appended to balance_ledger and folded into users.balance in
+# batches by flush_ledger(), so a popular referrer's row isn't locked once per
+# sign-up. A user's balance is therefore users.balance plus their unapplied
+# ledger entries, and referral_count likewise lags by the unapplied referrals.
+_PENDING_BALANCE = "COALESCE((SELECT SUM(amount) FROM balance_ledger WHERE user_id = u.id AND NOT applied), 0)"
+_PENDING_REFERRALS = "(SELECT COUNT(*) FROM balance_ledger WHERE user_id = u.id AND NOT applied AND reason = 'referral')"
+
+@_query
+def _update_balance(cur, user_id, amount):
+    cur.execute(f"""
+        WITH entry AS (
+            INSERT INTO balance_ledger (user_id, amount, reason) VALUES (%(user_id)s, %(amount)s, 'adjustment')
+            RETURNING amount
         )
+        SELECT u.balance + {_PENDING_BALANCE} + (SELECT amount FROM entry) FROM users u WHERE u.id = %(user_id)s
+    """, {'user_id': user_id, 'amount': amount})
+    return cur.fetchone()[0]
 
-def get_user(user_id):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT id, username, phone_number, referred_by, balance FROM users WHERE id = %s", (user_id,))
-        return cur.fetchone()
+async def update_balance(user_id, amount):
+    try:
+        balance = await _update_balance(user_id, amount)
+    except BaseException:
+        _balance_cache.invalidate(user_id)
+        raise
+    _balance_cache.update(user_id, balance)
+    return balance
 
-def update_balance(user_id, amount):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("UPDATE users SET balance = balance + %s WHERE id = %s RETURNING balance", (amount, user_id))
-        return cur.fetchone()[0]
+@_query
+def _get_balance(cur, user_id):
+    cur.execute(f"SELECT u.balance + {_PENDING_BALANCE} FROM users u WHERE u.id = %s", (user_id,))
+    result = cur.fetchone()
+    return result[0] if result else 0
 
-def get_balance(user_id):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT balance FROM users WHERE id = %s", (user_id,))
-        result = cur.fetchone()
-        return result[0] if result else 0
+async def get_balance(user_id):
+    balance = _balance_cache.get(user_id)
+    if balance is MISSING:
+        generation = _balance_cache.generation
+        balance = await _get_balance(user_id)
+        _balance_cache.set(user_id, balance, generation)
+    return balance
 
-# --- Referral Functions ---
-def add_referral(referrer_id, referred_id):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("INSERT INTO referrals (referrer_id, referred_id) VALUES (%s, %s)",(referrer_id, referred_id))
+def cache_stats():
+    """Hit/miss counters for the user and balance caches."""
+    return {'users': _user_cache.stats(), 'balances': _balance_cache.stats()}
+
+# --- Registration ---
+Registration = namedtuple('Registration', 'created referrer_id referral_count threshold_reached credited upline_credits')
+
+# Levels of referral_ancestry kept per user (migration 11 backfills the same
+# depth); reward tiers deeper than this are never paid.
+ANCESTRY_DEPTH = 10
+
+@_query
+def _register_user_with_referral(cur, user_id, username, phone_number, referrer_id, tiers, threshold, threshold_bonus, ip_address=None, phone_hash=None):
+    """
+    Insert the user, record the referral, extend referral_ancestry and append
+    the credits for every rewarded level (`tiers[0]` for the direct referrer,
+    `tiers[1]` for theirs, ...) plus the one-off threshold bonus to the ledger
+    in a single statement, so a sign-up is never half applied and never locks
+    an upline row. A referrer id that isn't a registered user is ignored, and
+    nothing is inserted if `phone_hash` already belongs to another user.
+    """
+    cur.execute(f"""
+        WITH new_user AS (
+            INSERT INTO users (id, username, phone_number, ip_address, referred_by, phone_hash)
+            SELECT %(user_id)s, %(username)s, %(phone_number)s, %(ip_address)s,
+                   (SELECT id FROM users WHERE id = %(referrer_id)s AND id <> %(user_id)s), %(phone_hash)s
+            ON CONFLICT DO NOTHING
+            RETURNING id, referred_by
+        ), new_referral AS (
+            INSERT INTO referrals (referrer_id, referred_id)
+            SELECT referred_by, id FROM new_user WHERE referred_by IS NOT NULL
+            RETURNING referrer_id, referred_id
+        ), ancestry AS (
+            -- The new user's ancestors are the referrer plus the referrer's own ancestors, one level further away.
+            INSERT INTO referral_ancestry (ancestor_id, descendant_id, depth)
+            SELECT referrer_id, referred_id, 1 FROM new_referral
+            UNION ALL
+            SELECT a.ancestor_id, nr.referred_id, a.depth + 1
+            FROM referral_ancestry a JOIN new_referral nr ON a.descendant_id = nr.referrer_id
+            WHERE a.depth < %(max_depth)s
+            RETURNING ancestor_id, descendant_id, depth
+        ), counted AS (
+            -- Statements in one WITH share a snapshot, so this referral is the +1.
+            SELECT u.id, u.referral_count + {_PENDING_REFERRALS} + 1 AS referral_count
+            FROM users u JOIN new_referral nr ON u.id = nr.referrer_id
+        ), credit AS (
+            -- 'referral' entries (level 1 only) are what flush_ledger() counts into referral_count.
+            INSERT INTO balance_ledger (user_id, amount, reason, ref_id)
+            SELECT ancestor_id, (%(tiers)s::int[])[depth], CASE WHEN depth = 1 THEN 'referral' ELSE 'referral_tier' END, descendant_id
+            FROM ancestry
+            WHERE depth <= cardinality(%(tiers)s::int[]) AND (depth = 1 OR (%(tiers)s::int[])[depth] <> 0)
+            RETURNING user_id, amount, reason
+        ), threshold_bonus AS (
+            -- Concurrent sign-ups can't see each other's entries, so the check is >=; the unique
+            -- index keeps it one bonus per user, and flush_ledger() pays any bonus a race skipped.
+            INSERT INTO balance_ledger (user_id, amount, reason)
+            SELECT id, %(threshold_bonus)s, 'threshold_bonus' FROM counted WHERE referral_count >= %(threshold)s
+            ON CONFLICT (user_id) WHERE reason = 'threshold_bonus' DO NOTHING
+            RETURNING user_id
+        )
+        SELECT EXISTS (SELECT 1 FROM new_user),
+               (SELECT user_id FROM credit WHERE reason = 'referral'),
+               (SELECT referral_count FROM counted),
+               EXISTS (SELECT 1 FROM threshold_bonus),
+               COALESCE((SELECT array_agg(ARRAY[user_id, amount]) FROM credit WHERE reason = 'referral_tier'), '{{}}')
+    """, {
+        'user_id': user_id, 'username': username, 'phone_number': phone_number, 'ip_address': ip_address,
+        'phone_hash': phone_hash, 'referrer_id': referrer_id, 'tiers': list(tiers), 'max_depth': ANCESTRY_DEPTH,
+        'threshold': threshold, 'threshold_bonus': threshold_bonus,
+    })
+    created, credited_id, count, threshold_reached, upline = cur.fetchone()
+    credited = (tiers[0] + (threshold_bonus if threshold_reached else 0)) if credited_id else 0
+    return Registration(created, credited_id, count or 0, threshold_reached, credited, [tuple(row) for row in upline])
+
+async def register_user_with_referral(user_id, username, phone_number, referrer_id, tiers, threshold, threshold_bonus, ip_address=None, phone_hash=None):
+    registration = await _register_user_with_referral(user_id, username, phone_number, referrer_id, tiers, threshold, threshold_bonus, ip_address, phone_hash)
+    if registration.created:
+        _user_cache.update(user_id, True)
+        _balance_cache.update(user_id, 0)
+    else:
+        _user_cache.invalidate(user_id)  # either already registered or refused as a duplicate
+    if registration.referrer_id:
+        _balance_cache.adjust(registration.referrer_id, registration.credited)
+    for ancestor_id, amount in registration.upline_credits:
+        _balance_cache.adjust(ancestor_id, amount)
+    return registration
+
+# --- Duplicate Account Functions ---
+@_query
+def count_phone_hashes(cur):
+    cur.execute("SELECT COUNT(phone_hash) FROM users")
+    return cur.fetchone()[0]
+
+@_query
+def load_phone_hashes(cur, add):
+    """Stream every stored phone hash into `add` without materialising them all."""
+    with cur.connection.cursor(name='phone_hashes') as named:
+        named.itersize = 50000
+        named.execute("SELECT phone_hash FROM users WHERE phone_hash IS NOT NULL")
+        for (value,) in named:
+            add(bytes(value))
 
-def get_user_referrals(user_id):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT u.id, u.username FROM referrals r JOIN users u ON r.referred_id = u.id WHERE r.referrer_id = %s ORDER BY r.timestamp DESC", (user_id,))
-        return cur.fetchall()
+@_query
+def get_phone_owner(cur, phone_hash):
+    cur.execute("SELECT id FROM users WHERE phone_hash = %s", (phone_hash,))
+    result = cur.fetchone()
+    return result[0] if result else None
 
-def get_referral_count(user_id):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = %s", (user_id,))
-        return cur.fetchone()[0]
+@_query
+def record_duplicate_attempt(cur, user_id, username, phone_hash, existing_user_id, referrer_id):
+    cur.execute(
+        "INSERT INTO duplicate_attempts (user_id, username, phone_hash, existing_user_id, referrer_id) VALUES (%s, %s, %s, %s, %s)",
+        (user_id, username, phone_hash, existing_user_id, referrer_id)
+    )
+
+@_query
+def get_duplicate_clusters(cur, limit=20):
+    """
+    Phone numbers with refused sign-ups, most attempts first, as
+    (owner_id, owner_username, attempts, [account ids], [referrer ids], last_attempt).
+    """
+    cur.execute("""
+        SELECT d.existing_user_id, u.username, COUNT(*), array_agg(DISTINCT d.user_id),
+               array_remove(array_agg(DISTINCT d.referrer_id), NULL), MAX(d.created_at)
+        FROM duplicate_attempts d LEFT JOIN users u ON u.id = d.existing_user_id
+        GROUP BY d.phone_hash, d.existing_user_id, u.username
+        ORDER BY COUNT(*) DESC, MAX(d.created_at) DESC
+        LIMIT %s
+    """, (limit,))
+    return cur.fetchall()
+
+# --- Referral Functions ---
+@_query
+def get_user_referrals_page(cur, user_id, after_id=None, before_id=None, limit=20):
+    """
+    Newest-first page of a user's referrals, keyset-paginated on (timestamp, id)
+    with the cursor given as a referral id. Returns (rows, total, has_more),
+    where rows are (referral_id, referred_user_id, username) and `has_more`
+    says whether another page exists in the direction requested.
+    """
+    cursor_id = before_id if before_id is not None else after_id
+    if cursor_id is None:
+        condition, order = "", "DESC"
+    elif before_id is not None:
+        condition, order = "AND (r.timestamp, r.id) > (SELECT timestamp, id FROM referrals WHERE id = %(cursor)s)", "ASC"
+    else:
+        condition, order = "AND (r.timestamp, r.id) < (SELECT timestamp, id FROM referrals WHERE id = %(cursor)s)", "DESC"
+    cur.execute(f"""
+        SELECT r.id, u.id, u.username
+        FROM referrals r JOIN users u ON r.referred_id = u.id
+        WHERE r.referrer_id = %(user_id)s {condition}
+        ORDER BY r.timestamp {order}, r.id {order}
+        LIMIT %(limit)s
+    """, {'user_id': user_id, 'cursor': cursor_id, 'limit': limit + 1})
+    rows = cur.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "ASC":
+        rows.reverse()
+    cur.execute(f"SELECT u.referral_count + {_PENDING_REFERRALS} FROM users u WHERE u.id = %s", (user_id,))
+    total = cur.fetchone()
+    return rows, total[0] if total else 0, has_more
+
+@_query
+def get_network_sizes(cur, user_id, max_depth):
+    """[(depth, members)] of the user's downline, level 1 being their direct referrals."""
+    cur.execute("""
+        SELECT depth, COUNT(*) FROM referral_ancestry
+        WHERE ancestor_id = %s AND depth <= %s
+        GROUP BY depth ORDER BY depth
+    """, (user_id, max_depth))
+    return cur.fetchall()
 
 # --- Withdrawal Functions ---
-def create_withdrawal_request(user_id, method, details, amount):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("UPDATE users SET balance = balance - %s WHERE id = %s", (amount, user_id))
-        cur.execute("INSERT INTO withdrawals (user_id, method, details, amount) VALUES (%s, %s, %s, %s) RETURNING id", (user_id, method, details, amount))
-        return cur.fetchone()[0]
-
-def get_pending_withdrawals():
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT w.id, w.user_id, u.username, w.method, w.details, w.amount FROM withdrawals w JOIN users u ON w.user_id = u.id WHERE w.status = 'pending' ORDER BY w.requested_at ASC")
-        return cur.fetchall()
-
-def update_withdrawal_status(withdrawal_id, status):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("UPDATE withdrawals SET status = %s WHERE id = %s", (status, withdrawal_id))
-
-def get_withdrawal_for_refund(withdrawal_id):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT user_id, amount FROM withdrawals WHERE id = %s", (withdrawal_id,))
-        return cur.fetchone()
+@_query
+def _create_withdrawal_request(cur, user_id, method, details, amount):
+    # Debits go straight to the user's own row (it isn't contended) and are logged as already applied.
+    cur.execute(f"UPDATE users u SET balance = balance - %s WHERE id = %s RETURNING balance + {_PENDING_BALANCE}", (amount, user_id))
+    balance = cur.fetchone()[0]
+    cur.execute("INSERT INTO withdrawals (user_id, method, details, amount) VALUES (%s, %s, %s, %s) RETURNING id", (user_id, method, details, amount))
+    withdrawal_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO balance_ledger (user_id, amount, reason, ref_id, applied) VALUES (%s, %s, 'withdrawal', %s, TRUE)", (user_id, -amount, withdrawal_id))
+    return withdrawal_id, balance
+
+async def create_withdrawal_request(user_id, method, details, amount):
+    try:
+        withdrawal_id, balance = await _create_withdrawal_request(user_id, method, details, amount)
+    except BaseException:
+        _balance_cache.invalidate(user_id)
+        raise
+    _balance_cache.update(user_id, balance)
+    return withdrawal_id
+
+@_query
+def get_pending_withdrawals_page(cur, method=None, after_id=None, before_id=None, limit=10):
+    """
+    One page of pending withdrawals in id order using keyset pagination: pass
+    `after_id` for the next page or `before_id` for the previous one.
+    Returns (rows, total_pending, has_prev, has_next).
+    """
+    method_filter = "AND w.method = %(method)s" if method else ""
+    params = {'method': method, 'after_id': after_id, 'before_id': before_id, 'limit': limit + 1}
+    if before_id is not None:
+        cur.execute(f"""
+            SELECT w.id, w.user_id, u.username, w.method, w.details, w.amount
+            FROM withdrawals w JOIN users u ON w.user_id = u.id
+            WHERE w.status = 'pending' {method_filter} AND w.id < %(before_id)s
+            ORDER BY w.id DESC LIMIT %(limit)s
+        """, params)
+        rows = cur.fetchall()
+        has_prev, has_next = len(rows) > limit, True
+        rows = rows[:limit][::-1]
+    else:
+        cur.execute(f"""
+            SELECT w.id, w.user_id, u.username, w.method, w.details, w.amount
+            FROM withdrawals w JOIN users u ON w.user_id = u.id
+            WHERE w.status = 'pending' {method_filter} AND w.id > COALESCE(%(after_id)s, 0)
+            ORDER BY w.id LIMIT %(limit)s
+        """, params)
+        rows = cur.fetchall()
+        has_prev, has_next = after_id is not None, len(rows) > limit
+        rows = rows[:limit]
+    if rows and has_prev and before_id is None:
+        cur.execute(f"SELECT EXISTS (SELECT 1 FROM withdrawals w WHERE w.status = 'pending' {method_filter} AND w.id < %(first)s)", {**params, 'first': rows[0][0]})
+        has_prev = cur.fetchone()[0]
+    cur.execute(f"SELECT COUNT(*) FROM withdrawals w WHERE w.status = 'pending' {method_filter}", params)
+    return rows, cur.fetchone()[0], has_prev, has_next
+
+@_query
+def approve_withdrawals(cur, withdrawal_ids):
+    """Approve every still-pending withdrawal in `withdrawal_ids` in one transaction; returns the (id, user_id, amount, method) rows settled."""
+    cur.execute("UPDATE withdrawals SET status = 'approved' WHERE id = ANY(%s) AND status = 'pending' RETURNING id, user_id, amount, method", (list(withdrawal_ids),))
+    return cur.fetchall()
+
+@_query
+def _reject_withdrawals(cur, withdrawal_ids):
+    cur.execute("""
+        WITH rejected AS (
+            UPDATE withdrawals SET status = 'rejected'
+            WHERE id = ANY(%s) AND status = 'pending'
+            RETURNING id, user_id, amount, method
+        ), refunded AS (
+            UPDATE users u SET balance = u.balance + r.total
+            FROM (SELECT user_id, SUM(amount) AS total FROM rejected GROUP BY user_id) r
+            WHERE u.id = r.user_id
+        ), logged AS (
+            INSERT INTO balance_ledger (user_id, amount, reason, ref_id, applied)
+            SELECT user_id, amount, 'refund', id, TRUE FROM rejected
+        )
+        SELECT id, user_id, amount, method FROM rejected
+    """, (list(withdrawal_ids),))
+    return cur.fetchall()
+
+async def reject_withdrawals(withdrawal_ids):
+    """Reject still-pending withdrawals and refund their amounts in one transaction; returns the (id, user_id, amount, method) rows settled."""
+    try:
+        rows = await _reject_withdrawals(withdrawal_ids)
+    except BaseException:
+        _balance_cache.clear()
+        raise
+    for _, user_id, _, _ in rows:
+        _balance_cache.invalidate(user_id)
+    return rows
+
+@_query
+def _flush_ledger(cur, threshold, threshold_bonus, batch_size=10000):
+    """
+    Fold up to `batch_size` unapplied ledger entries into users.balance and
+    referral_count with one UPDATE per batch, then pay any threshold bonus a
+    sign-up race skipped. Returns (entries applied, [(user_id, bonus)] newly
+    awarded). Only one flush runs at a time across processes.
+    """
+    cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('balance_ledger_flush'))")
+    if not cur.fetchone()[0]:
+        return 0, []
+    cur.execute("""
+        WITH batch AS (
+            SELECT id, user_id, amount, reason FROM balance_ledger WHERE NOT applied ORDER BY id LIMIT %(batch_size)s
+        ), marked AS (
+            UPDATE balance_ledger l SET applied = TRUE FROM batch b WHERE l.id = b.id
+        ), totals AS (
+            SELECT user_id, SUM(amount) AS amount, COUNT(*) FILTER (WHERE reason = 'referral') AS referrals
+            FROM batch GROUP BY user_id
+        ), folded AS (
+            UPDATE users u SET balance = u.balance + t.amount, referral_count = u.referral_count + t.referrals
+            FROM totals t WHERE u.id = t.user_id
+            RETURNING u.id, u.referral_count, t.referrals
+        ), awarded AS (
+            INSERT INTO balance_ledger (user_id, amount, reason)
+            SELECT id, %(threshold_bonus)s, 'threshold_bonus' FROM folded
+            WHERE referral_count >= %(threshold)s AND referral_count - referrals < %(threshold)s
+            ON CONFLICT (user_id) WHERE reason = 'threshold_bonus' DO NOTHING
+            RETURNING user_id, amount
+        )
+        SELECT (SELECT COUNT(*) FROM batch), COALESCE((SELECT array_agg(ARRAY[user_id, amount]) FROM awarded), '{}')
+    """, {'batch_size': batch_size, 'threshold': threshold, 'threshold_bonus': threshold_bonus})
+    applied, awarded = cur.fetchone()
+    return applied, [tuple(row) for row in awarded]
+
+async def flush_ledger(threshold, threshold_bonus, batch_size=10000):
+    applied, awarded = await _flush_ledger(threshold, threshold_bonus, batch_size)
+    for user_id, bonus in awarded:
+        _balance_cache.adjust(user_id, bonus)
+    return applied, awarded
+
+# --- Exports ---
+# table -> (query, timestamp column for date filters, status column or None)
+EXPORTS = {
+    'users': ("""
+        SELECT u.id, u.username, u.referred_by, u.referral_count, u.balance + COALESCE(p.amount, 0) AS balance, u.joined_at
+        FROM users u LEFT JOIN (SELECT user_id, SUM(amount) AS amount FROM balance_ledger WHERE NOT applied GROUP BY user_id) p
+            ON p.user_id = u.id
+    """, 'u.joined_at', None),
+    'referrals': ("""
+        SELECT r.id, r.referrer_id, r.referred_id, r.timestamp FROM referrals r
+    """, 'r.timestamp', None),
+    'withdrawals': ("""
+        SELECT w.id, w.user_id, u.username, w.method, w.details, w.amount, w.status, w.requested_at
+        FROM withdrawals w LEFT JOIN users u ON u.id = w.user_id
+    """, 'w.requested_at', 'w.status'),
+}
+
+@_query
+def export_csv(cur, table, out, status=None, since=None, until=None):
+    """
+    COPY one of EXPORTS as CSV (with header) into the binary file `out`,
+    optionally filtered by status and an inclusive date range. Rows stream
+    straight from the server, so memory use doesn't depend on the row count.
+    Returns the number of rows written.
+    """
+    query, timestamp_column, status_column = EXPORTS[table]
+    conditions, params = [], []
+    if status and status_column:
+        conditions.append(f"{status_column} = %s"); params.append(status)
+    if since:
+        conditions.append(f"{timestamp_column} >= %s"); params.append(since)
+    if until:
+        conditions.append(f"{timestamp_column} < %s::date + 1"); params.append(until)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    select = cur.mogrify(f"{query} {where} ORDER BY 1", params).decode()
+    cur.copy_expert(f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)", out)
+    return cur.rowcount
 
 # --- Admin & Statistics Functions ---
-def get_total_user_count():
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM users")
-        return cur.fetchone()[0]
-
-def get_top_referrers(limit=10):
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT u.username, COUNT(r.id) as ref_count, u.balance FROM users u LEFT JOIN referrals r ON u.id = r.referrer_id GROUP BY u.id ORDER BY ref_count DESC, u.balance DESC LIMIT %s", (limit,))
-        return cur.fetchall()
-
-def get_all_user_ids():
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT id FROM users")
-        return [row[0] for row in cur.fetchall()]
+@_query
+def add_stats(cur, deltas):
+    """Fold `((hour, metric, dim), delta)` pairs into the hourly rollups and the running totals."""
+    rows = [(hour, metric, dim, delta) for (hour, metric, dim), delta in deltas]
+    extras.execute_values(cur, """
+        INSERT INTO stats_hourly (hour, metric, dim, value) VALUES %s
+        ON CONFLICT (hour, metric, dim) DO UPDATE SET value = stats_hourly.value + EXCLUDED.value
+    """, rows)
+    totals = {}
+    for _, metric, dim, delta in rows:
+        totals[(metric, dim)] = totals.get((metric, dim), 0) + delta
+    extras.execute_values(cur, """
+        INSERT INTO stats_totals (metric, dim, value) VALUES %s
+        ON CONFLICT (metric, dim) DO UPDATE SET value = stats_totals.value + EXCLUDED.value
+    """, [(metric, dim, value) for (metric, dim), value in totals.items()])
+
+@_query
+def get_stats(cur, since):
+    """All running totals plus the hourly rollups from `since` onwards."""
+    cur.execute("SELECT metric, dim, value FROM stats_totals")
+    totals = cur.fetchall()
+    cur.execute("SELECT hour, metric, dim, value FROM stats_hourly WHERE hour >= %s", (since,))
+    return totals, cur.fetchall()
+
+@_query
+def get_top_referrers(cur, limit=10):
+    cur.execute("SELECT username, referral_count, balance FROM users WHERE referral_count > 0 ORDER BY referral_count DESC, balance DESC LIMIT %s", (limit,))
+    return cur.fetchall()
+
+# --- Broadcast Functions ---
+@_query
+def create_broadcast(cur, from_chat_id, message_id, admin_chat_id, owner, lease_seconds):
+    cur.execute("""
+        INSERT INTO broadcasts (from_chat_id, message_id, admin_chat_id, owner, lease_until)
+        VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s)) RETURNING id
+    """, (from_chat_id, message_id, admin_chat_id, owner, lease_seconds))
+    return cur.fetchone()[0]
+
+@_query
+def claim_broadcasts(cur, owner, lease_seconds):
+    """
+    Take over running broadcasts whose lease has lapsed (their process stopped
+    or died) and return them. SKIP LOCKED plus the lease means each broadcast
+    is picked up by exactly one process.
+    """
+    cur.execute("""
+        UPDATE broadcasts b SET owner = %s, lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+        FROM (
+            SELECT id FROM broadcasts
+            WHERE status = 'running' AND (lease_until IS NULL OR lease_until < CURRENT_TIMESTAMP)
+            FOR UPDATE SKIP LOCKED
+        ) free
+        WHERE b.id = free.id
+        RETURNING b.id, b.from_chat_id, b.message_id, b.admin_chat_id, b.last_user_id, b.sent, b.failed
+    """, (owner, lease_seconds))
+    return sorted(cur.fetchall())
+
+@_query
+def release_broadcasts(cur, owner):
+    """Give up the leases `owner` holds so another process can resume its broadcasts straight away."""
+    cur.execute("UPDATE broadcasts SET lease_until = NULL WHERE owner = %s AND status = 'running'", (owner,))
+
+@_query
+def renew_broadcast_lease(cur, broadcast_id, owner, lease_seconds):
+    """Extend `owner`'s lease; False if another process has claimed the broadcast."""
+    cur.execute("""
+        UPDATE broadcasts SET lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+        WHERE id = %s AND owner = %s AND status = 'running'
+    """, (lease_seconds, broadcast_id, owner))
+    return cur.rowcount == 1
+
+@_query
+def get_broadcast_recipients(cur, after_user_id, limit):
+    """Next chunk of recipient ids in primary-key order, so memory stays flat and progress is a single cursor."""
+    cur.execute("SELECT id FROM users WHERE id > %s ORDER BY id LIMIT %s", (after_user_id, limit))
+    return [row[0] for row in cur.fetchall()]
+
+@_query
+def record_broadcast_progress(cur, broadcast_id, results, last_user_id, owner, lease_seconds):
+    """
+    Store per-recipient outcomes, advance the resume cursor and renew the
+    lease in one transaction. Returns False (and records nothing) if `owner`
+    no longer holds the broadcast.
+    """
+    cur.execute("""
+        UPDATE broadcasts SET lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+        WHERE id = %s AND owner = %s AND status = 'running'
+    """, (lease_seconds, broadcast_id, owner))
+    if cur.rowcount != 1:
+        return False
+    extras.execute_values(
+        cur,
+        "INSERT INTO broadcast_deliveries (broadcast_id, user_id, delivered) VALUES %s ON CONFLICT DO NOTHING",
+        [(broadcast_id, user_id, delivered) for user_id, delivered in results],
+    )
+    delivered = sum(1 for _, ok in results if ok)
+    cur.execute(
+        "UPDATE broadcasts SET last_user_id = %s, sent = sent + %s, failed = failed + %s WHERE id = %s",
+        (last_user_id, delivered, len(results) - delivered, broadcast_id)
+    )
+    return True
+
+@_query
+def finish_broadcast(cur, broadcast_id):
+    cur.execute("UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = %s", (broadcast_id,))
+
+# --- Notification Functions ---
+@_query
+def add_dead_letters(cur, rows):
+    """rows: (chat_id, text, options json, attempts, error) for notifications that could not be delivered."""
+    extras.execute_values(cur, "INSERT INTO notification_dead_letters (chat_id, text, options, attempts, error) VALUES %s",
+                          rows, template="(%s, %s, %s::jsonb, %s, %s)")
+
+# --- Persistence Functions ---
+@_query
+def load_persistence_data(cur, kind, owner_id):
+    cur.execute("SELECT key, value::text FROM persistence_data WHERE kind = %s AND owner_id = %s", (kind, owner_id))
+    return cur.fetchall()
+
+@_query
+def get_conversation_states(cur, name):
+    cur.execute("SELECT key, state::text FROM conversation_states WHERE name = %s", (name,))
+    return cur.fetchall()
+
+@_query
+def write_persistence_batch(cur, upserts, deletes, drops, conversation_upserts, conversation_deletes):
+    """Apply one batch of changed persistence keys and conversation states in a single transaction."""
+    if drops:
+        extras.execute_values(cur, "DELETE FROM persistence_data d USING (VALUES %s) AS x(kind, owner_id) WHERE d.kind = x.kind AND d.owner_id = x.owner_id", drops)
+    if deletes:
+        extras.execute_values(cur, "DELETE FROM persistence_data d USING (VALUES %s) AS x(kind, owner_id, key) WHERE (d.kind, d.owner_id, d.key) = (x.kind, x.owner_id, x.key)", deletes)
+    if upserts:
+        extras.execute_values(cur, """
+            INSERT INTO persistence_data (kind, owner_id, key, value) VALUES %s
+            ON CONFLICT (kind, owner_id, key) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
+        """, upserts, template="(%s, %s, %s, %s::jsonb)")
+    if conversation_deletes:
+        extras.execute_values(cur, "DELETE FROM conversation_states c USING (VALUES %s) AS x(name, key) WHERE (c.name, c.key) = (x.name, x.key)", conversation_deletes)
+    if conversation_upserts:
+        extras.execute_values(cur, """
+            INSERT INTO conversation_states (name, key, state) VALUES %s
+            ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state
+        """, conversation_upserts, template="(%s, %s, %s::jsonb)")
@@ -0,0 +1,37 @@
+# bot/export.py
+import gzip
+import logging
+import os
+import tempfile
+from datetime import date
+
+from telegram.error import TelegramError
+
+from . import database as db
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024  # Bot API limit for send_document
+
+
+async def run(bot, chat_id, table, status=None, since=None, until=None):
+    """Stream `table` into a gzipped CSV on disk and send it to `chat_id` as a document."""
+    filters = "-".join(str(part) for part in (status, since, until) if part)
+    filename = f"{table}{'-' + filters if filters else ''}-{date.today():%Y%m%d}.csv.gz"
+    with tempfile.TemporaryDirectory(prefix='export-') as directory:
+        path = os.path.join(directory, filename)
+        try:
+            with gzip.open(path, 'wb') as out:
+                rows = await db.export_csv(table, out, status, since, until)
+            size = os.path.getsize(path)
+            if size > MAX_UPLOAD_BYTES:
+                await bot.send_message(chat_id, f"⚠️ The {table} export is {size // (1024 * 1024)} MB, over Telegram's 50 MB limit. Narrow the date range and try again.")
+                return
+            with open(path, 'rb') as document:
+                await bot.send_document(chat_id, document, filename=filename, caption=f"📄 {table}: {rows} row(s)",
+                                        read_timeout=300, write_timeout=300)
+        except TelegramError as e:
+            logger.warning(f"Could not send the {table} export: {e}")
+        except Exception:
+            logger.exception(f"Export of {table} failed")
+            await bot.send_message(chat_id, f"❌ The {table} export failed; see the logs for details.")
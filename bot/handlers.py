@@ -1,25 +1,45 @@
 # bot/handlers.py
+import functools
 import os
 import logging
+import time
+from datetime import datetime, timedelta
 from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.constants import ParseMode
+from . import broadcast
 from . import database as db
+from . import export
 from . import keyboards
+from . import membership
+from . import notify
+from . import phones
+from . import render
+from . import stats
 
 # --- Environment Variables & Constants ---
 # This line is crucial. It loads the ID from Render and converts it to an integer.
 ADMIN_ID = int(os.environ.get('ADMIN_TELEGRAM_ID'))
 CHANNEL_ID = os.environ.get('FORCE_JOIN_CHANNEL')
-REFERRAL_BONUS = 5
+# ETB paid per sign-up to each level of the upline: the direct referrer first, then their referrer, ...
+REFERRAL_TIERS = [int(amount) for amount in os.environ.get('REFERRAL_TIERS', '5').split(',')][:db.ANCESTRY_DEPTH]
+REFERRAL_BONUS = REFERRAL_TIERS[0]
+NETWORK_LEVELS = max(len(REFERRAL_TIERS), 3)  # levels shown under My Network
 MIN_WITHDRAWAL = 100
 BONUS_THRESHOLD = 10
 BONUS_AMOUNT = 10
+LEADERBOARD_TTL = 30  # seconds the rendered Top Referrers screen is reused
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 10))
+REFERRALS_PAGE_SIZE = 20
+LEDGER_FLUSH_INTERVAL = float(os.environ.get('LEDGER_FLUSH_INTERVAL', 5))  # seconds between folding credits into balances
+LEDGER_FLUSH_BATCH = 10000
 
 # --- State definitions for ConversationHandlers ---
 (ASK_WITHDRAWAL_METHOD, ASK_WITHDRAWAL_DETAILS, ASK_WITHDRAWAL_AMOUNT) = range(3)
 (ASK_BROADCAST_MESSAGE, CONFIRM_BROADCAST) = range(3, 5)
 
+_leaderboard = (0.0, None)  # (expires_at, rendered text)
+
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -48,13 +68,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except (IndexError, ValueError):
         context.user_data['referrer_id'] = None
 
-    if db.user_exists(user.id):
+    if await db.user_exists(user.id):
         await show_main_menu(update, "Welcome back!")
         return
 
     try:
-        member = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user.id)
-        if member.status not in ['member', 'administrator', 'creator']:
+        if not await membership.is_member(context.bot, CHANNEL_ID, user.id):
             await send_verification_message(update)
         else:
             await ask_for_phone(update)
@@ -65,8 +84,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def verify_join_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    member = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=query.from_user.id)
-    if member.status in ['member', 'administrator', 'creator']:
+    if await membership.is_member(context.bot, CHANNEL_ID, query.from_user.id):
         await query.message.delete()
         await ask_for_phone(update)
     else:
@@ -74,29 +92,45 @@ async def verify_join_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    phone_number = update.message.contact.phone_number
-
-    if db.user_exists(user.id): return
+    contact = update.message.contact
+    if contact.user_id != user.id:
+        await update.message.reply_text("Please share your own phone number using the button below.", reply_markup=keyboards.request_phone_keyboard())
+        return
+    phone_hash = phones.phone_hash(contact.phone_number)
 
     referrer_id = context.user_data.get('referrer_id')
-    db.add_user(user.id, user.username or user.first_name, None, referrer_id) # IP address field is there but we are not using it yet
-
-    if referrer_id:
-        db.add_referral(referrer_id, user.id)
-        db.update_balance(referrer_id, REFERRAL_BONUS)
-        await notify_referrer(context, referrer_id, user)
-        
-        referral_count = db.get_referral_count(referrer_id)
-        if referral_count == BONUS_THRESHOLD:
-            db.update_balance(referrer_id, BONUS_AMOUNT)
-            await context.bot.send_message(
-                chat_id=referrer_id,
-                text=f"🎉 **BONUS!** You've reached {BONUS_THRESHOLD} referrals and earned an extra **{BONUS_AMOUNT} ETB**! Keep going!"
-            )
+    # Only numbers the filter can't rule out cost a lookup before registering.
+    if phones.maybe_registered(phone_hash):
+        owner_id = await db.get_phone_owner(phone_hash)
+        if owner_id is not None and owner_id != user.id:
+            await refuse_duplicate(update, phone_hash, owner_id, referrer_id)
+            return
+    # Telegram never reveals a user's IP address, so ip_address stays empty.
+    registration = await db.register_user_with_referral(user.id, user.username or user.first_name, None, referrer_id, REFERRAL_TIERS, BONUS_THRESHOLD, BONUS_AMOUNT, phone_hash=phone_hash)
+    if not registration.created:
+        # Lost a race to another account registering the same number.
+        if not await db.user_exists(user.id):
+            await refuse_duplicate(update, phone_hash, await db.get_phone_owner(phone_hash), referrer_id)
+        return
+    phones.add(phone_hash)
+    stats.record('signups')
+
+    if registration.referrer_id:
+        stats.record('referrals')
+        stats.record('credits_paid', value=registration.credited + sum(amount for _, amount in registration.upline_credits))
+        notify_referrer(context, registration.referrer_id, user)
+        if registration.threshold_reached:
+            notify_threshold_bonus(context.bot, registration.referrer_id)
 
     await update.message.reply_text("✅ Registration complete! Welcome.", reply_markup=ReplyKeyboardRemove())
     await show_main_menu(update, "Here is your dashboard:")
 
+async def refuse_duplicate(update: Update, phone_hash, owner_id, referrer_id):
+    user = update.effective_user
+    await db.record_duplicate_attempt(user.id, user.username or user.first_name, phone_hash, owner_id, referrer_id)
+    stats.record('duplicates_refused')
+    await update.message.reply_text("⚠️ This phone number is already registered to another account. Only one account per person is allowed.", reply_markup=ReplyKeyboardRemove())
+
 
 # --- (The rest of handlers.py remains the same as the previous "Final, Verified Code" version) ---
 # --- You can copy the rest from the previous good version, or just trust that it's correct. ---
@@ -108,48 +142,83 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     data = query.data
 
+    if data.startswith(('admin_', 'wd_')) and query.from_user.id != ADMIN_ID: return
+
     if data == 'main_menu': await show_main_menu(update, "Welcome to the main menu:", edit=True)
     elif data == 'my_balance': await my_balance_handler(update)
     elif data == 'refer_friends': await refer_friends_handler(update, context)
     elif data == 'my_referrals': await my_referrals_handler(update)
+    elif data.startswith('myref:'):
+        _, direction, cursor, page = data.split(':')
+        if direction == 'n': await my_referrals_handler(update, after_id=int(cursor), page=int(page))
+        else: await my_referrals_handler(update, before_id=int(cursor), page=int(page))
+    elif data == 'my_network': await my_network_handler(update)
     elif data == 'top_referrers': await top_referrers_handler(update)
     elif data == 'statistics': await statistics_handler(update)
     elif data == 'help_support': await help_support_handler(update)
     elif data == 'admin_stats': await admin_stats_handler(update)
-    elif data == 'admin_withdrawals': await admin_withdrawals_handler(update)
+    elif data == 'admin_panel': await edit_or_reply(update, "🧑‍💻 Welcome to the Admin Panel!", keyboards.admin_panel_keyboard())
+    elif data == 'admin_withdrawals': await admin_withdrawals_handler(update, context)
+    elif data == 'admin_duplicates': await admin_duplicates_handler(update)
+    elif data.startswith('wd_'): await withdrawals_page_action(update, context)
     elif data.startswith('admin_approve_'): await approve_withdrawal(update, context)
     elif data.startswith('admin_reject_'): await reject_withdrawal(update, context)
 
 async def my_balance_handler(update: Update):
-    balance = db.get_balance(update.effective_user.id)
+    balance = await db.get_balance(update.effective_user.id)
     await edit_or_reply(update, f"💰 **My Balance**\n\nYour current balance is: **{balance} ETB**", keyboards.back_to_menu_keyboard())
 
 async def refer_friends_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    bot_username = (await context.bot.get_me()).username
-    referral_link = f"https://t.me/{bot_username}?start={update.effective_user.id}"
-    text = f"👥 **Refer & Earn**\n\nInvite friends and earn **{REFERRAL_BONUS} ETB** for each one!\n\nYour link:\n`{referral_link}`"
+    text = render.refer_friends_text(context.bot.username, update.effective_user.id, REFERRAL_BONUS)
     await edit_or_reply(update, text, keyboards.back_to_menu_keyboard())
 
-async def my_referrals_handler(update: Update):
-    referrals = db.get_user_referrals(update.effective_user.id)
-    text = f"📝 **My Referrals ({len(referrals)})**\n\n" + ("\n".join([f"- @{u[1]}" if u[1] else f"- User ID: {u[0]}" for u in referrals[:20]]) or "You haven't referred anyone yet.")
+async def my_referrals_handler(update: Update, after_id=None, before_id=None, page=1):
+    rows, total, has_more = await db.get_user_referrals_page(update.effective_user.id, after_id, before_id, REFERRALS_PAGE_SIZE)
+    if not rows:
+        await edit_or_reply(update, "📝 **My Referrals (0)**\n\nYou haven't referred anyone yet.", keyboards.back_to_menu_keyboard())
+        return
+    pages = -(-total // REFERRALS_PAGE_SIZE)
+    text = f"📝 **My Referrals ({total})**" + (f" - page {page}/{pages}" if pages > 1 else "") + "\n\n" + "\n".join([f"- @{u[2]}" if u[2] else f"- User ID: {u[1]}" for u in rows])
+    has_prev, has_next = (page > 1, has_more) if before_id is None else (has_more, True)
+    await edit_or_reply(update, text, keyboards.my_referrals_keyboard(rows[0][0], rows[-1][0], page, has_prev, has_next))
+
+async def my_network_handler(update: Update):
+    sizes = dict(await db.get_network_sizes(update.effective_user.id, NETWORK_LEVELS))
+    lines = []
+    for level in range(1, NETWORK_LEVELS + 1):
+        reward = f" - {REFERRAL_TIERS[level - 1]} ETB each" if level <= len(REFERRAL_TIERS) else ""
+        lines.append(f"Level {level}: **{sizes.get(level, 0)}**{reward}")
+    text = f"🌐 **My Network ({sum(sizes.values())})**\n\n" + "\n".join(lines)
     await edit_or_reply(update, text, keyboards.back_to_menu_keyboard())
 
 async def top_referrers_handler(update: Update):
-    top_users = db.get_top_referrers()
-    text = "🏆 **Top 10 Referrers**\n\n" + ("\n".join([f"{i+1}. @{u[0] or 'user'} - {u[1]} referrals" for i, u in enumerate(top_users)]) or "No referrals recorded yet.")
+    global _leaderboard
+    expires_at, text = _leaderboard
+    if text is None or time.monotonic() >= expires_at:
+        top_users = await db.get_top_referrers()
+        text = "🏆 **Top 10 Referrers**\n\n" + ("\n".join([f"{i+1}. @{u[0] or 'user'} - {u[1]} referrals" for i, u in enumerate(top_users)]) or "No referrals recorded yet.")
+        _leaderboard = (time.monotonic() + LEADERBOARD_TTL, text)
     await edit_or_reply(update, text, keyboards.back_to_menu_keyboard())
 
 async def statistics_handler(update: Update):
-    await edit_or_reply(update, f"📊 **Bot Statistics**\n\nTotal Users: **{db.get_total_user_count()}**", keyboards.back_to_menu_keyboard())
+    totals, _, _ = await stats.snapshot(hours=1)
+    await edit_or_reply(update, f"📊 **Bot Statistics**\n\nTotal Users: **{totals[('signups', '')]}**", keyboards.back_to_menu_keyboard())
+
+def _upline_rewards_text():
+    if len(REFERRAL_TIERS) < 2: return ""
+    levels = ", ".join(f"{amount} ETB at level {level}" for level, amount in enumerate(REFERRAL_TIERS[1:], start=2) if amount)
+    return f" When the people you invited bring friends, you earn {levels}."
+
+@functools.cache
+def _help_text():
+    return f"❓ **Help & Support**\n\n**How it works:** Share your referral link. When a friend joins and completes verification, you earn {REFERRAL_BONUS} ETB.{_upline_rewards_text()}\n\n**Withdrawals:** You need a minimum of {MIN_WITHDRAWAL} ETB.\n\n**Bonus:** Get an extra {BONUS_AMOUNT} ETB when you refer {BONUS_THRESHOLD} people!\n\nFor issues, contact the admin."
 
 async def help_support_handler(update: Update):
-    text = f"❓ **Help & Support**\n\n**How it works:** Share your referral link. When a friend joins and completes verification, you earn {REFERRAL_BONUS} ETB.\n\n**Withdrawals:** You need a minimum of {MIN_WITHDRAWAL} ETB.\n\n**Bonus:** Get an extra {BONUS_AMOUNT} ETB when you refer {BONUS_THRESHOLD} people!\n\nFor issues, contact the admin."
-    await edit_or_reply(update, text, keyboards.back_to_menu_keyboard())
+    await edit_or_reply(update, _help_text(), keyboards.back_to_menu_keyboard())
 
 async def start_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    balance = db.get_balance(query.from_user.id)
+    balance = await db.get_balance(query.from_user.id)
     if balance < MIN_WITHDRAWAL:
         await query.answer(f"You need at least {MIN_WITHDRAWAL} ETB. Your balance is {balance} ETB.", show_alert=True)
         return ConversationHandler.END
@@ -178,10 +247,11 @@ async def withdrawal_amount_received(update: Update, context: ContextTypes.DEFAU
     except ValueError:
         await update.message.reply_text("Invalid input. Please enter a number."); return ASK_WITHDRAWAL_AMOUNT
 
-    withdrawal_id = db.create_withdrawal_request(update.effective_user.id, context.user_data['withdrawal_method'], context.user_data['withdrawal_details'], amount)
+    withdrawal_id = await db.create_withdrawal_request(update.effective_user.id, context.user_data['withdrawal_method'], context.user_data['withdrawal_details'], amount)
+    stats.record('withdrawals_requested', context.user_data['withdrawal_method'])
     await update.message.reply_text("✅ Your withdrawal request has been submitted successfully!")
     await show_main_menu(update, "Welcome to the main menu:")
-    await notify_admin_of_withdrawal(context, update.effective_user, context.user_data['withdrawal_method'], context.user_data['withdrawal_details'], amount, withdrawal_id)
+    notify_admin_of_withdrawal(context, update.effective_user, context.user_data['withdrawal_method'], context.user_data['withdrawal_details'], amount, withdrawal_id)
     return ConversationHandler.END
 
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -190,61 +260,161 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await update.message.reply_text("🧑‍💻 Welcome to the Admin Panel!", reply_markup=keyboards.admin_panel_keyboard())
 
+EXPORT_USAGE = ("Usage: /export <users|referrals|withdrawals> [status] [from YYYY-MM-DD] [to YYYY-MM-DD]\n"
+                "e.g. /export withdrawals approved 2024-01-01 2024-01-31")
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    args = list(context.args)
+    table = args.pop(0).lower() if args else None
+    if table not in db.EXPORTS:
+        await update.message.reply_text(EXPORT_USAGE)
+        return
+    status = args.pop(0).lower() if args and table == 'withdrawals' and not args[0][:1].isdigit() else None
+    try:
+        dates = [datetime.strptime(arg, '%Y-%m-%d').date() for arg in args]
+    except ValueError:
+        dates = None
+    if dates is None or len(dates) > 2:
+        await update.message.reply_text(EXPORT_USAGE)
+        return
+    since, until = (dates + [None, None])[:2]
+    await update.message.reply_text(f"⏳ Exporting {table}; the file will be sent here when it's ready.")
+    # Runs as its own task so the admin's other updates aren't queued behind a long export.
+    context.application.create_task(export.run(context.bot, update.effective_chat.id, table, status, since, until), update=update)
+
+def _sparkline(values):
+    bars = "▁▂▃▄▅▆▇█"
+    peak = max(values) or 1
+    return "".join(bars[v * (len(bars) - 1) // peak] for v in values)
+
 async def admin_stats_handler(update: Update):
-    text = f"📊 **Bot Statistics**\n\nTotal Users: **{db.get_total_user_count()}**"
-    await edit_or_reply(update, text, keyboards.admin_panel_keyboard())
-
-async def admin_withdrawals_handler(update: Update):
-    await update.callback__query.edit_message_text("Fetching pending withdrawals...")
-    pending = db.get_pending_withdrawals()
-    if not pending:
-        await edit_or_reply(update, "No pending withdrawals.", keyboards.admin_panel_keyboard())
+    totals, hourly, since = await stats.snapshot(hours=24)
+    def total(metric, dim=None): return sum(v for (m, d), v in totals.items() if m == metric and dim in (None, d))
+    def last_day(metric, dim=None): return sum(v for (_, m, d), v in hourly.items() if m == metric and dim in (None, d))
+    signups_by_hour = [hourly[(since + timedelta(hours=i), 'signups', '')] for i in range(24)]
+
+    lines = [
+        "📊 **Bot Statistics** (last 24h in brackets)\n",
+        f"Total Users: **{total('signups')}** (+{last_day('signups')})",
+        f"Referrals: **{total('referrals')}** (+{last_day('referrals')})",
+        f"Credits Paid: **{total('credits_paid')} ETB** (+{last_day('credits_paid')})",
+        f"Sign-ups per hour: `{_sparkline(signups_by_hour)}`\n",
+        "**Withdrawals** requested / approved / rejected:",
+    ]
+    for method, label in keyboards.WITHDRAWAL_METHODS.items():
+        lines.append(f"{label}: {total('withdrawals_requested', method)} / {total('withdrawals_approved', method)} / {total('withdrawals_rejected', method)}"
+                     f" (+{last_day('withdrawals_requested', method)} / +{last_day('withdrawals_approved', method)} / +{last_day('withdrawals_rejected', method)})")
+    caches = db.cache_stats()
+    lines.append(f"\nUser cache: {caches['users']['hit_rate']:.0%} hits | Balance cache: {caches['balances']['hit_rate']:.0%} hits")
+    await edit_or_reply(update, "\n".join(lines), keyboards.admin_panel_keyboard())
+
+async def admin_withdrawals_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, method=None, after_id=None, before_id=None, notice=None):
+    rows, total, has_prev, has_next = await db.get_pending_withdrawals_page(method, after_id, before_id, ADMIN_PAGE_SIZE)
+    if not rows and (after_id or before_id):  # the page was emptied by a bulk action
+        after_id = before_id = None
+        rows, total, has_prev, has_next = await db.get_pending_withdrawals_page(method, limit=ADMIN_PAGE_SIZE)
+    ids = [row[0] for row in rows]
+    selected = [w_id for w_id in context.user_data.get('wd_selected', []) if w_id in ids]
+    context.user_data['wd_selected'] = selected
+    context.user_data['wd_view'] = {'method': method, 'after_id': after_id, 'before_id': before_id, 'ids': ids}
+
+    header = f"⏳ **Pending Withdrawals{f' ({keyboards.WITHDRAWAL_METHODS[method]})' if method else ''}: {total}**"
+    lines = [f"**#{w_id}** @{u_name} ({u_id}) - **{amount} ETB**\n{w_method}: `{details}`" for w_id, u_id, u_name, w_method, details, amount in rows]
+    text = "\n\n".join(([notice] if notice else []) + [header] + (lines or ["No pending withdrawals."]))
+    await edit_or_reply(update, text, keyboards.admin_withdrawals_page_keyboard(ids, selected, method, has_prev, has_next))
+
+async def withdrawals_page_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Page navigation, filters, selection and bulk actions of the pending-withdrawals view."""
+    data = update.callback_query.data
+    view = context.user_data.get('wd_view') or {}
+    method, after_id, before_id = view.get('method'), view.get('after_id'), view.get('before_id')
+    notice = None
+
+    if data.startswith('wd_page:'):
+        _, method_key, direction, cursor = data.split(':')
+        method = None if method_key == 'ALL' else method_key
+        after_id, before_id = (int(cursor), None) if direction == 'n' else (None, int(cursor))
+    elif data.startswith('wd_filter:'):
+        method_key = data.split(':')[1]
+        method, after_id, before_id = (None if method_key == 'ALL' else method_key), None, None
+    elif data.startswith('wd_sel:'):
+        w_id = int(data.split(':')[1])
+        selected = context.user_data.setdefault('wd_selected', [])
+        if w_id in selected: selected.remove(w_id)
+        else: selected.append(w_id)
+    elif data == 'wd_approve_page':
+        settled = await db.approve_withdrawals(view.get('ids', []))
+        for *_, method_settled in settled: stats.record('withdrawals_approved', method_settled)
+        notice = f"✅ Approved {len(settled)} withdrawal(s)."
+    elif data == 'wd_reject_selected':
+        settled = await db.reject_withdrawals(context.user_data.get('wd_selected', []))
+        context.user_data['wd_selected'] = []
+        notice = f"❌ Rejected and refunded {len(settled)} withdrawal(s)."
+        for _, user_id, amount, method_settled in settled:
+            stats.record('withdrawals_rejected', method_settled)
+            notify_refund(context, user_id, amount)
+
+    await admin_withdrawals_handler(update, context, method, after_id, before_id, notice)
+
+async def admin_duplicates_handler(update: Update):
+    clusters = await db.get_duplicate_clusters()
+    if not clusters:
+        await edit_or_reply(update, "🚩 **Duplicate Accounts**\n\nNo duplicate sign-ups have been refused.", keyboards.admin_panel_keyboard())
         return
-    await edit_or_reply(update, f"Found {len(pending)} pending withdrawal(s):", keyboards.admin_panel_keyboard())
-    for w_id, u_id, u_name, method, details, amount in pending:
-        text = f"**ID:** {w_id} | **User:** @{u_name} ({u_id})\n**Method:** {method}\n**Details:** `{details}`\n**Amount:** {amount} ETB"
-        await update.effective_message.reply_text(text, reply_markup=keyboards.admin_withdrawal_keyboard(w_id), parse_mode=ParseMode.MARKDOWN)
+    lines = []
+    for owner_id, owner_username, attempts, account_ids, referrer_ids, last_attempt in clusters:
+        owner = f"@{owner_username} ({owner_id})" if owner_username else f"User {owner_id}"
+        line = f"• {owner}: **{attempts}** attempt(s) from {len(account_ids)} account(s), last {last_attempt:%Y-%m-%d %H:%M}"
+        if referrer_ids: line += f"\n   via referrer(s): {', '.join(map(str, referrer_ids))}"
+        lines.append(line)
+    await edit_or_reply(update, "🚩 **Duplicate Accounts** (refused sign-ups by phone number)\n\n" + "\n".join(lines), keyboards.admin_panel_keyboard())
 
 async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Reached through the broadcast ConversationHandler, not button_handler, so it needs its own check.
+    if update.effective_user.id != ADMIN_ID:
+        await update.callback_query.answer()
+        return ConversationHandler.END
     await update.callback_query.edit_message_text("Please send the message you want to broadcast. To cancel, type /cancel.")
     return ASK_BROADCAST_MESSAGE
 
 async def broadcast_message_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['broadcast_message'] = update.message
+    context.user_data['broadcast_source'] = (update.message.chat_id, update.message.message_id)
     await update.message.reply_text("This is the message you're about to send. Are you sure? Type 'YES' to confirm or /cancel to abort.")
     return CONFIRM_BROADCAST
 
 async def broadcast_confirmed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return ConversationHandler.END
     if update.message.text.upper() != 'YES':
         await update.message.reply_text("Broadcast aborted.")
         await admin_command(update, context)
         return ConversationHandler.END
 
-    await update.message.reply_text("Broadcasting... this may take a while.")
-    sent_count, failed_count = 0, 0
-    for user_id in db.get_all_user_ids():
-        try:
-            await context.user_data['broadcast_message'].copy(chat_id=user_id)
-            sent_count += 1
-        except Exception:
-            failed_count += 1
-    await update.message.reply_text(f"Broadcast complete.\nSent: {sent_count}\nFailed: {failed_count}")
+    from_chat_id, message_id = context.user_data.pop('broadcast_source')
+    broadcast_id = await broadcast.start(context.bot, update.effective_chat.id, from_chat_id, message_id)
+    await update.message.reply_text(f"Broadcast #{broadcast_id} started. Progress will be posted here.")
     return ConversationHandler.END
 
 async def approve_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query; await query.answer("Approving...")
+    query = update.callback_query
     withdrawal_id = int(query.data.split('_')[2])
-    db.update_withdrawal_status(withdrawal_id, 'approved')
-    await query.edit_message_text(text=query.message.text + "\n\n**Status: ✅ Approved**", parse_mode=ParseMode.MARKDOWN)
+    settled = await db.approve_withdrawals([withdrawal_id])
+    for *_, method in settled: stats.record('withdrawals_approved', method)
+    status = "✅ Approved" if settled else "⚠️ Already processed"
+    await query.edit_message_text(text=query.message.text + f"\n\n**Status: {status}**", parse_mode=ParseMode.MARKDOWN)
 
 async def reject_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query; await query.answer("Rejecting...")
+    query = update.callback_query
     withdrawal_id = int(query.data.split('_')[2])
-    user_to_refund, amount_to_refund = db.get_withdrawal_for_refund(withdrawal_id)
-    if user_to_refund: db.update_balance(user_to_refund, amount_to_refund)
-    db.update_withdrawal_status(withdrawal_id, 'rejected')
-    await query.edit_message_text(text=query.message.text + "\n\n**Status: ❌ Rejected (Amount Refunded)**", parse_mode=ParseMode.MARKDOWN)
-    await context.bot.send_message(chat_id=user_to_refund, text=f"Your withdrawal request was rejected by the admin. The amount of {amount_to_refund} ETB has been returned to your balance.")
+    settled = await db.reject_withdrawals([withdrawal_id])
+    status = "❌ Rejected (Amount Refunded)" if settled else "⚠️ Already processed"
+    await query.edit_message_text(text=query.message.text + f"\n\n**Status: {status}**", parse_mode=ParseMode.MARKDOWN)
+    for _, user_id, amount, method in settled:
+        stats.record('withdrawals_rejected', method)
+        notify_refund(context, user_id, amount)
 
 async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Action cancelled.", reply_markup=ReplyKeyboardRemove())
@@ -270,9 +440,32 @@ async def edit_or_reply(update: Update, text: str, reply_markup):
     if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
     else: await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
 
-async def notify_referrer(context, referrer_id, new_user):
-    await context.bot.send_message(chat_id=referrer_id, text=f"🎉 Congratulations! User **{new_user.first_name}** joined with your link. You've earned **{REFERRAL_BONUS} ETB**!", parse_mode=ParseMode.MARKDOWN)
+async def flush_ledger(bot):
+    """Fold pending credits into balances until the backlog is drained."""
+    while True:
+        applied, awarded = await db.flush_ledger(BONUS_THRESHOLD, BONUS_AMOUNT, LEDGER_FLUSH_BATCH)
+        for user_id, bonus in awarded:
+            # A sign-up race skipped this bonus at registration; the flush paid it instead.
+            stats.record('credits_paid', value=bonus)
+            notify_threshold_bonus(bot, user_id)
+        if applied < LEDGER_FLUSH_BATCH:
+            return
+
+async def ledger_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await flush_ledger(context.bot)
+    except Exception:
+        logger.exception("Could not flush the balance ledger")
+
+def notify_threshold_bonus(bot, user_id):
+    notify.send(bot, user_id, f"🎉 **BONUS!** You've reached {BONUS_THRESHOLD} referrals and earned an extra **{BONUS_AMOUNT} ETB**! Keep going!")
+
+def notify_referrer(context, referrer_id, new_user):
+    notify.send(context.bot, referrer_id, f"🎉 Congratulations! User **{new_user.first_name}** joined with your link. You've earned **{REFERRAL_BONUS} ETB**!", parse_mode=ParseMode.MARKDOWN)
+
+def notify_refund(context, user_id, amount):
+    notify.send(context.bot, user_id, f"Your withdrawal request was rejected by the admin. The amount of {amount} ETB has been returned to your balance.")
 
-async def notify_admin_of_withdrawal(context, user, method, details, amount, w_id):
+def notify_admin_of_withdrawal(context, user, method, details, amount, w_id):
     text = f"⚠️ **New Withdrawal Request!**\n\n**User:** @{user.username} ({user.id})\n**Method:** {method}\n**Details:** `{details}`\n**Amount:** {amount} ETB"
-    await context.bot.send_message(chat_id=ADMIN_ID, text=text, reply_markup=keyboards.admin_withdrawal_keyboard(w_id), parse_mode=ParseMode.MARKDOWN)
+    notify.send(context.bot, ADMIN_ID, text, reply_markup=keyboards.admin_withdrawal_keyboard(w_id), parse_mode=ParseMode.MARKDOWN)
@@ -0,0 +1,73 @@
+# bot/httpd.py
+"""
+Minimal asyncio HTTP/1.1 server for the bot's own endpoints (webhook, health).
+It only understands Content-Length bodies, which is all Telegram and load
+balancer health checks send.
+"""
+import asyncio
+from http import HTTPStatus
+
+MAX_BODY = 1024 * 1024
+MAX_HEADERS = 100
+IDLE_TIMEOUT = 75  # seconds a keep-alive connection may sit idle or take to send one request
+
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise ValueError("too many headers")
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        raise ValueError("request body too large")
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target.split('?', 1)[0], headers, body
+
+
+def _response(status, body=b'', content_type='text/plain; charset=utf-8', keep_alive=True):
+    status = HTTPStatus(status)
+    head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode('latin-1') + body
+
+
+async def serve(handler, host, port):
+    """
+    Start serving. `handler(method, path, headers, body)` is awaited for every
+    request and returns `(status, body_bytes, content_type)`. Returns the
+    asyncio Server; close it to stop.
+    """
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(_read_request(reader), IDLE_TIMEOUT)
+                except ValueError:
+                    writer.write(_response(400, b'bad request', keep_alive=False))
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload, content_type = await handler(method, path, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(_response(status, payload, content_type, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connection, host, port)
@@ -1,27 +1,42 @@
 # bot/keyboards.py
+import functools
 import os
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
 
+# Markup objects are immutable, so keyboards that take no arguments are built
+# once on first use and the same object is sent every time.
+
+@functools.cache
 def verify_join_keyboard():
     channel_username = os.environ.get('FORCE_JOIN_CHANNEL', '').lstrip('@')
     keyboard = [[InlineKeyboardButton("✅ I Have Joined", callback_data='verify_join')],[InlineKeyboardButton("➡️ Join Channel", url=f"https://t.me/{channel_username}")]]
     return InlineKeyboardMarkup(keyboard)
 
+@functools.cache
 def request_phone_keyboard():
     return ReplyKeyboardMarkup([[KeyboardButton("📱 Share My Phone Number", request_contact=True)]], one_time_keyboard=True, resize_keyboard=True)
 
+@functools.cache
 def main_menu_keyboard():
     keyboard = [
         [InlineKeyboardButton("💰 My Balance", callback_data='my_balance'), InlineKeyboardButton("👥 Refer Friends", callback_data='refer_friends')],
         [InlineKeyboardButton("📝 My Referrals", callback_data='my_referrals'), InlineKeyboardButton("💸 Withdraw", callback_data='withdraw')],
         [InlineKeyboardButton("🏆 Top Referrers", callback_data='top_referrers'), InlineKeyboardButton("📊 Statistics", callback_data='statistics')],
-        [InlineKeyboardButton("❓ Help & Support", callback_data='help_support')]
+        [InlineKeyboardButton("🌐 My Network", callback_data='my_network'), InlineKeyboardButton("❓ Help & Support", callback_data='help_support')]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@functools.cache
 def back_to_menu_keyboard():
     return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Main Menu", callback_data='main_menu')]])
 
+def my_referrals_keyboard(first_id, last_id, page, has_prev, has_next):
+    nav = []
+    if has_prev: nav.append(InlineKeyboardButton("⬅️ Newer", callback_data=f'myref:p:{first_id}:{page - 1}'))
+    if has_next: nav.append(InlineKeyboardButton("Older ➡️", callback_data=f'myref:n:{last_id}:{page + 1}'))
+    return InlineKeyboardMarkup(([nav] if nav else []) + [[InlineKeyboardButton("⬅️ Back to Main Menu", callback_data='main_menu')]])
+
+@functools.cache
 def withdrawal_methods_keyboard():
     keyboard = [
         [InlineKeyboardButton("💵 Telebirr", callback_data='withdraw_telebirr'), InlineKeyboardButton("🏦 CBE Bank", callback_data='withdraw_cbe')],
@@ -30,13 +45,33 @@ def withdrawal_methods_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@functools.cache
 def admin_panel_keyboard():
     keyboard = [
         [InlineKeyboardButton("📊 View Statistics", callback_data='admin_stats')],
         [InlineKeyboardButton("📢 Broadcast Message", callback_data='admin_broadcast')],
-        [InlineKeyboardButton("⏳ Pending Withdrawals", callback_data='admin_withdrawals')]
+        [InlineKeyboardButton("⏳ Pending Withdrawals", callback_data='admin_withdrawals')],
+        [InlineKeyboardButton("🚩 Duplicate Accounts", callback_data='admin_duplicates')]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+WITHDRAWAL_METHODS = {'TELEBIRR': 'Telebirr', 'CBE': 'CBE', 'USDT': 'USDT'}
+
+def admin_withdrawals_page_keyboard(withdrawal_ids, selected, method, has_prev, has_next):
+    """Selection toggles for the page, prev/next, method filters and bulk actions. `method` is None for all methods."""
+    filter_key = method or 'ALL'
+    toggles = [InlineKeyboardButton(f"{'☑️' if w_id in selected else '⬜'} #{w_id}", callback_data=f'wd_sel:{w_id}') for w_id in withdrawal_ids]
+    keyboard = [toggles[i:i + 3] for i in range(0, len(toggles), 3)]
+    nav = []
+    if has_prev: nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f'wd_page:{filter_key}:p:{withdrawal_ids[0]}'))
+    if has_next: nav.append(InlineKeyboardButton("Next ➡️", callback_data=f'wd_page:{filter_key}:n:{withdrawal_ids[-1]}'))
+    if nav: keyboard.append(nav)
+    labels = {'ALL': 'All', **WITHDRAWAL_METHODS}
+    keyboard.append([InlineKeyboardButton(f"{'• ' if filter_key == key else ''}{label}", callback_data=f'wd_filter:{key}') for key, label in labels.items()])
+    if withdrawal_ids:
+        keyboard.append([InlineKeyboardButton("✅ Approve page", callback_data='wd_approve_page'), InlineKeyboardButton(f"❌ Reject selected ({len(selected)})", callback_data='wd_reject_selected')])
+    keyboard.append([InlineKeyboardButton("⬅️ Admin Panel", callback_data='admin_panel')])
+    return InlineKeyboardMarkup(keyboard)
+
 def admin_withdrawal_keyboard(withdrawal_id):
     return InlineKeyboardMarkup([[InlineKeyboardButton("✅ Approve", callback_data=f'admin_approve_{withdrawal_id}'), InlineKeyboardButton("❌ Reject", callback_data=f'admin_reject_{withdrawal_id}')]])
@@ -0,0 +1,43 @@
+# bot/lifecycle.py
+"""
+Helpers for the serving modes that drive an Application by hand (webhook and
+worker processes) instead of through run_polling.
+"""
+import contextlib
+
+from telegram.ext import ConversationHandler
+
+
+def iter_handlers(application):
+    """Every registered handler, with ConversationHandlers flattened into their children."""
+    def visit(handler):
+        if isinstance(handler, ConversationHandler):
+            for child in handler.entry_points + handler.fallbacks:
+                yield from visit(child)
+            for state_handlers in handler.states.values():
+                for child in state_handlers:
+                    yield from visit(child)
+            return
+        yield handler
+
+    for group in application.handlers.values():
+        for handler in group:
+            yield from visit(handler)
+
+
+@contextlib.asynccontextmanager
+async def running(application):
+    """Initialise and start `application` with its post_* hooks, the same sequence run_polling uses."""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        yield application
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,57 @@
+# bot/membership.py
+import asyncio
+import os
+
+from .cache import MISSING, TTLCache
+
+JOINED_STATUSES = ('member', 'administrator', 'creator')
+# Members rarely leave, so positives live long; negatives only absorb button mashing.
+POSITIVE_TTL = float(os.environ.get('MEMBERSHIP_CACHE_TTL', 600))
+NEGATIVE_TTL = float(os.environ.get('MEMBERSHIP_NEGATIVE_TTL', 5))
+CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', 100000))
+
+_members = TTLCache(CACHE_SIZE, POSITIVE_TTL)
+_non_members = TTLCache(CACHE_SIZE, NEGATIVE_TTL)
+_in_flight = {}
+api_calls = 0
+coalesced = 0
+
+
+async def is_member(bot, chat_id, user_id):
+    """
+    Whether `user_id` has joined `chat_id`. Concurrent checks for the same user
+    share one get_chat_member call; API errors are raised to every waiter and
+    are not cached.
+    """
+    global coalesced
+    key = (chat_id, user_id)
+    if _members.get(key) is not MISSING:
+        return True
+    if _non_members.get(key) is not MISSING:
+        return False
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_check(bot, chat_id, user_id))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    else:
+        coalesced += 1
+    # Shielded so one cancelled handler doesn't cancel the check for the others.
+    return await asyncio.shield(task)
+
+
+async def _check(bot, chat_id, user_id):
+    global api_calls
+    api_calls += 1
+    member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+    joined = member.status in JOINED_STATUSES
+    if joined:
+        _members.set((chat_id, user_id), True)
+        _non_members.invalidate((chat_id, user_id))
+    else:
+        _non_members.set((chat_id, user_id), True)
+    return joined
+
+
+def stats():
+    return {'api_calls': api_calls, 'coalesced': coalesced, 'members': _members.stats(), 'non_members': _non_members.stats()}
@@ -0,0 +1,226 @@
+# bot/metrics.py
+"""
+Latency histograms and error counters for handlers, database queries and Bot
+API calls, served in Prometheus text format on METRICS_PORT and optionally
+logged as periodic JSON summaries. When METRICS_PORT is unset nothing is
+wrapped, so the hot paths carry no instrumentation at all.
+"""
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+
+from telegram.request import HTTPXRequest
+
+from . import database as db
+from . import httpd
+from . import lifecycle
+from . import membership
+from . import notify
+from . import render
+
+logger = logging.getLogger(__name__)
+
+PORT = int(os.environ.get('METRICS_PORT', 0))
+HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+LOG_INTERVAL = int(os.environ.get('METRICS_LOG_INTERVAL', 0))  # seconds; 0 disables log summaries
+ENABLED = bool(PORT or LOG_INTERVAL)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.total += seconds
+        self.count += 1
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q):
+        """Upper bucket bound containing the q-quantile; good enough for log summaries."""
+        target, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return BUCKETS[-1]
+
+
+# name -> {label tuple -> Histogram | number}
+_histograms = defaultdict(lambda: defaultdict(Histogram))
+_counters = defaultdict(lambda: defaultdict(int))
+_gauges = {}  # name -> (help, fn returning {label tuple: value})
+_help = {}
+_server = None
+
+
+def observe(name, labels, seconds, help_text=''):
+    _histograms[name][labels].observe(seconds)
+    _help.setdefault(name, help_text)
+
+
+def inc(name, labels, value=1, help_text=''):
+    _counters[name][labels] += value
+    _help.setdefault(name, help_text)
+
+
+def register_gauge(name, help_text, fn):
+    """`fn()` returns {labels: value}, where labels is a tuple of (key, value) pairs."""
+    _gauges[name] = (help_text, fn)
+
+
+# --- Instrumentation ---
+def _timed_callback(name, callback):
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            inc('bot_handler_errors_total', (('handler', name),), help_text="Exceptions raised by handlers")
+            raise
+        finally:
+            observe('bot_handler_duration_seconds', (('handler', name),), time.perf_counter() - started, "Handler latency")
+    return timed
+
+
+def instrument_application(application):
+    """Wrap the callback of every registered handler, including those inside ConversationHandlers."""
+    for handler in lifecycle.iter_handlers(application):
+        handler.callback = _timed_callback(handler.callback.__name__, handler.callback)
+
+
+def _observe_query(name, seconds, failed):
+    observe('bot_db_query_duration_seconds', (('query', name),), seconds, "Database call latency, including waiting for a connection")
+    if failed:
+        inc('bot_db_errors_total', (('query', name),), help_text="Failed database calls")
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPX transport that times every Bot API call by method."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            inc('bot_api_errors_total', (('method', api_method), ('status', 'network')), help_text="Failed Bot API calls")
+            raise
+        finally:
+            observe('bot_api_request_duration_seconds', (('method', api_method),), time.perf_counter() - started, "Bot API call latency")
+        if status >= 400:
+            inc('bot_api_errors_total', (('method', api_method), ('status', str(status))), help_text="Failed Bot API calls")
+        return status, payload
+
+
+def install(application):
+    """Wire up handler and database instrumentation plus the built-in gauges."""
+    instrument_application(application)
+    db._observer = _observe_query
+    register_gauge('bot_db_pool_connections', "Database pool connections by state",
+                   lambda: {(('state', k),): v for k, v in db.pool_stats().items()})
+    register_gauge('bot_update_queue_size', "Updates fetched but not yet handed to the processor",
+                   lambda: {(): application.update_queue.qsize()})
+    processor = application.update_processor
+    if hasattr(processor, 'stats'):
+        register_gauge('bot_updates', "Update processor state (in_flight, pending = queue depth, processed)",
+                       lambda: {(('state', k),): v for k, v in processor.stats().items()})
+    register_gauge('bot_cache', "Read-through cache hits, misses and size",
+                   lambda: {(('cache', cache), ('stat', stat)): value
+                            for cache, values in db.cache_stats().items()
+                            for stat, value in values.items() if stat != 'hit_rate'})
+    register_gauge('bot_membership_checks', "Channel-membership checks: Bot API calls made and checks coalesced",
+                   lambda: {(('stat', k),): v for k, v in membership.stats().items() if not isinstance(v, dict)})
+    register_gauge('bot_render_cache', "Rendered per-user screens: cache hits, misses and size",
+                   lambda: {(('stat', k),): v for k, v in render.cache_stats().items()})
+    register_gauge('bot_notifications', "Background notification queue: queued, sent, retried, dead-lettered, pending",
+                   lambda: {(('stat', k),): v for k, v in notify.stats().items()})
+
+
+# --- Exposition ---
+def _format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in pairs) + '}'
+
+
+def exposition():
+    lines = []
+    for name, series in _histograms.items():
+        lines += [f"# HELP {name} {_help.get(name, '')}", f"# TYPE {name} histogram"]
+        for labels, hist in series.items():
+            cumulative = 0
+            for bound, n in zip(BUCKETS, hist.counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {hist.total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+    for name, series in _counters.items():
+        lines += [f"# HELP {name} {_help.get(name, '')}", f"# TYPE {name} counter"]
+        lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in series.items()]
+    for name, (help_text, fn) in _gauges.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        try:
+            lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in fn().items()]
+        except Exception:
+            logger.exception(f"Gauge {name} failed")
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """Compact per-series view (count, mean, p95) for structured logs."""
+    out = {}
+    for name, series in _histograms.items():
+        for labels, hist in series.items():
+            if hist.count:
+                key = name + ''.join(f'.{v}' for _, v in labels)
+                out[key] = {'count': hist.count, 'mean_ms': round(hist.total / hist.count * 1000, 1), 'p95_ms': hist.quantile(0.95) * 1000}
+    for name, series in _counters.items():
+        for labels, value in series.items():
+            out[name + ''.join(f'.{v}' for _, v in labels)] = value
+    for name, (_, fn) in _gauges.items():
+        try:
+            for labels, value in fn().items():
+                out[name + ''.join(f'.{v}' for _, v in labels)] = value
+        except Exception:
+            pass
+    return out
+
+
+async def _handle(method, path, headers, body):
+    if path == '/metrics' and method == 'GET':
+        return 200, exposition().encode(), 'text/plain; version=0.0.4; charset=utf-8'
+    return 404, b'not found', 'text/plain'
+
+
+async def log_summary_job(context):
+    logger.info(json.dumps({'metrics': summary()}))
+
+
+async def start(application):
+    global _server
+    if PORT:
+        _server = await httpd.serve(_handle, HOST, PORT)
+        logger.info(f"Metrics on http://{HOST}:{PORT}/metrics")
+    if LOG_INTERVAL:
+        application.job_queue.run_repeating(log_summary_job, interval=LOG_INTERVAL, first=LOG_INTERVAL)
+
+
+async def stop():
+    global _server
+    if _server:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
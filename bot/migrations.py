@@ -0,0 +1,319 @@
+# bot/migrations.py
+"""
+Versioned schema migrations. Append new migrations to MIGRATIONS with the next
+version number; never edit one that has already shipped.
+"""
+import logging
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# `concurrent` migrations run outside a transaction, one statement at a time,
+# so they can use CREATE INDEX CONCURRENTLY without blocking writes.
+Migration = namedtuple('Migration', 'version description statements concurrent')
+
+LOCK_ID = 4242001  # pg advisory lock so only one process migrates at a time
+LOCK_POLL_INTERVAL = 0.5  # seconds between attempts to take LOCK_ID
+
+MIGRATIONS = [
+    Migration(1, "baseline users, referrals and withdrawals tables", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            phone_number VARCHAR(20),
+            referred_by BIGINT,
+            balance INT DEFAULT 0,
+            joined_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS ip_address VARCHAR(45)",
+        """
+        CREATE TABLE IF NOT EXISTS referrals (
+            id SERIAL PRIMARY KEY,
+            referrer_id BIGINT REFERENCES users(id),
+            referred_id BIGINT REFERENCES users(id),
+            timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(id),
+            method VARCHAR(50),
+            details VARCHAR(255),
+            amount INT,
+            status VARCHAR(20) DEFAULT 'pending',
+            requested_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ], False),
+    Migration(2, "broadcast progress tables", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            from_chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            admin_chat_id BIGINT NOT NULL,
+            status VARCHAR(20) DEFAULT 'running',
+            last_user_id BIGINT DEFAULT 0,
+            sent INT DEFAULT 0,
+            failed INT DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP WITH TIME ZONE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INT REFERENCES broadcasts(id),
+            user_id BIGINT,
+            delivered BOOLEAN NOT NULL,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+        """,
+    ], False),
+    Migration(3, "users.referral_count counter", [
+        """
+        DO $$
+        BEGIN
+            ALTER TABLE users ADD COLUMN referral_count INT NOT NULL DEFAULT 0;
+            UPDATE users u SET referral_count = r.n
+            FROM (SELECT referrer_id, COUNT(*) AS n FROM referrals GROUP BY referrer_id) r
+            WHERE u.id = r.referrer_id;
+        EXCEPTION
+            WHEN duplicate_column THEN -- already present
+        END;
+        $$
+        """,
+    ], False),
+    Migration(4, "indexes for referral, withdrawal and leaderboard queries", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_leaderboard_idx ON users (referral_count DESC, balance DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS referrals_referrer_idx ON referrals (referrer_id, timestamp DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS referrals_referred_idx ON referrals (referred_id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS withdrawals_status_idx ON withdrawals (status, requested_at)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS withdrawals_user_idx ON withdrawals (user_id)",
+    ], True),
+    Migration(5, "partial indexes for paginating pending withdrawals", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS withdrawals_pending_idx ON withdrawals (id) WHERE status = 'pending'",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS withdrawals_pending_method_idx ON withdrawals (method, id) WHERE status = 'pending'",
+    ], True),
+    Migration(6, "keyset index for paging a user's referrals", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS referrals_referrer_page_idx ON referrals (referrer_id, timestamp DESC, id DESC)",
+        "DROP INDEX CONCURRENTLY IF EXISTS referrals_referrer_idx",
+    ], True),
+    Migration(7, "incremental statistics rollups, backfilled from the base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            hour TIMESTAMP WITH TIME ZONE NOT NULL,
+            metric VARCHAR(50) NOT NULL,
+            dim VARCHAR(50) NOT NULL DEFAULT '',
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, metric, dim)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            metric VARCHAR(50) NOT NULL,
+            dim VARCHAR(50) NOT NULL DEFAULT '',
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (metric, dim)
+        )
+        """,
+        "INSERT INTO stats_hourly SELECT date_trunc('hour', joined_at), 'signups', '', COUNT(*) FROM users GROUP BY 1",
+        "INSERT INTO stats_hourly SELECT date_trunc('hour', timestamp), 'referrals', '', COUNT(*) FROM referrals GROUP BY 1",
+        "INSERT INTO stats_hourly SELECT date_trunc('hour', requested_at), 'withdrawals_requested', method, COUNT(*) FROM withdrawals GROUP BY 1, 3",
+        # Decisions were never timestamped, so historic ones are filed under the request hour.
+        """
+        INSERT INTO stats_hourly
+        SELECT date_trunc('hour', requested_at), 'withdrawals_' || status, method, COUNT(*)
+        FROM withdrawals WHERE status IN ('approved', 'rejected') GROUP BY 1, 2, 3
+        """,
+        "INSERT INTO stats_totals SELECT metric, dim, SUM(value) FROM stats_hourly GROUP BY 1, 2",
+        # Balances only ever grow through credits, so everything credited so far is
+        # what users still hold plus what they have withdrawn (rejections are refunded).
+        """
+        INSERT INTO stats_totals
+        SELECT 'credits_paid', '',
+               (SELECT COALESCE(SUM(balance), 0) FROM users)
+             + (SELECT COALESCE(SUM(amount), 0) FROM withdrawals WHERE status IN ('pending', 'approved'))
+        """,
+    ], False),
+    Migration(8, "conversation persistence", [
+        """
+        CREATE TABLE IF NOT EXISTS persistence_data (
+            kind CHAR(1) NOT NULL,
+            owner_id BIGINT NOT NULL,
+            key TEXT NOT NULL,
+            value JSONB NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, owner_id, key)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            name VARCHAR(100) NOT NULL,
+            key TEXT NOT NULL,
+            state JSONB NOT NULL,
+            PRIMARY KEY (name, key)
+        )
+        """,
+    ], False),
+    Migration(9, "dead-lettered notifications", [
+        """
+        CREATE TABLE IF NOT EXISTS notification_dead_letters (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            options JSONB NOT NULL DEFAULT '{}',
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ], False),
+    Migration(10, "balance ledger for coalesced referral credits", [
+        """
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(id),
+            amount INT NOT NULL,
+            reason VARCHAR(20) NOT NULL,
+            ref_id BIGINT,
+            applied BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS balance_ledger_unapplied_idx ON balance_ledger (user_id) WHERE NOT applied",
+        "CREATE INDEX IF NOT EXISTS balance_ledger_user_idx ON balance_ledger (user_id, id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS balance_ledger_threshold_bonus_idx ON balance_ledger (user_id) WHERE reason = 'threshold_bonus'",
+        # Existing balances become one opening entry each, so the ledger sums to users.balance from day one.
+        "INSERT INTO balance_ledger (user_id, amount, reason, applied) SELECT id, balance, 'opening', TRUE FROM users WHERE balance <> 0",
+        # Users already past the threshold in force at the time (10) were paid inside their opening balance;
+        # a zero marker row stops the bonus being paid again.
+        "INSERT INTO balance_ledger (user_id, amount, reason, applied) SELECT id, 0, 'threshold_bonus', TRUE FROM users WHERE referral_count >= 10",
+    ], False),
+    Migration(11, "referral ancestry closure table", [
+        """
+        CREATE TABLE IF NOT EXISTS referral_ancestry (
+            ancestor_id BIGINT NOT NULL REFERENCES users(id),
+            descendant_id BIGINT NOT NULL REFERENCES users(id),
+            depth SMALLINT NOT NULL,
+            PRIMARY KEY (ancestor_id, depth, descendant_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS referral_ancestry_descendant_idx ON referral_ancestry (descendant_id, depth)",
+        # Backfill from the direct referrals, keeping the same 10 levels bot.database.ANCESTRY_DEPTH does.
+        """
+        INSERT INTO referral_ancestry (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE chain (ancestor_id, descendant_id, depth) AS (
+            SELECT referrer_id, referred_id, 1 FROM referrals
+            UNION ALL
+            SELECT r.referrer_id, c.descendant_id, c.depth + 1
+            FROM chain c JOIN referrals r ON r.referred_id = c.ancestor_id
+            WHERE c.depth < 10
+        )
+        SELECT ancestor_id, descendant_id, depth FROM chain
+        ON CONFLICT DO NOTHING
+        """,
+    ], False),
+    Migration(12, "hashed phone numbers and duplicate-account attempts", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS phone_hash BYTEA",
+        """
+        CREATE TABLE IF NOT EXISTS duplicate_attempts (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            username VARCHAR(255),
+            phone_hash BYTEA NOT NULL,
+            existing_user_id BIGINT,
+            referrer_id BIGINT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS duplicate_attempts_phone_idx ON duplicate_attempts (phone_hash)",
+    ], False),
+    Migration(13, "unique index on hashed phone numbers", [
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_phone_hash_idx ON users (phone_hash)",
+    ], True),
+    Migration(14, "broadcast leases so one process runs each broadcast", [
+        "ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS owner VARCHAR(100)",
+        "ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP WITH TIME ZONE",
+    ], False),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(cur):
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+
+def _drop_invalid_indexes(cur):
+    """An interrupted CREATE INDEX CONCURRENTLY leaves an invalid index that IF NOT EXISTS would skip."""
+    cur.execute("""
+        SELECT c.relname FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE NOT i.indisvalid AND n.nspname = current_schema()
+    """)
+    for (name,) in cur.fetchall():
+        logger.warning(f"Dropping invalid index {name} left by an interrupted migration")
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+
+def _apply(cur, migration):
+    if migration.concurrent:
+        _drop_invalid_indexes(cur)
+        for statement in migration.statements:
+            cur.execute(statement)
+        cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (migration.version, migration.description))
+        return
+    cur.execute("BEGIN")
+    try:
+        for statement in migration.statements:
+            cur.execute(statement)
+        cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (migration.version, migration.description))
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+
+def migrate(conn):
+    """
+    Apply pending migrations on `conn` (switched to autocommit). When the schema
+    is already current this costs two catalog reads and runs no DDL.
+    Returns the number of migrations applied.
+    """
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        if current_version(cur) >= LATEST_VERSION:
+            return 0
+        # Poll rather than block in pg_advisory_lock: a session waiting inside that
+        # statement holds a snapshot, and the lock holder's CREATE INDEX
+        # CONCURRENTLY waits for every older snapshot, so the two would deadlock.
+        while True:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (LOCK_ID,))
+            if cur.fetchone()[0]:
+                break
+            time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            applied = current_version(cur)  # another process may have migrated while we waited
+            pending = [m for m in MIGRATIONS if m.version > applied]
+            for migration in pending:
+                logger.info(f"Applying migration {migration.version}: {migration.description}")
+                _apply(cur, migration)
+            return len(pending)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (LOCK_ID,))
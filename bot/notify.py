@@ -0,0 +1,134 @@
+# bot/notify.py
+import asyncio
+import json
+import logging
+import os
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from . import database as db
+from .ratelimit import bot_limiter, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get('NOTIFY_WORKERS', 8))
+MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', 5))
+MAX_BACKOFF = 60
+DRAIN_TIMEOUT = 10  # seconds stop() waits for queued notifications before dead-lettering them
+
+_queue = None
+_workers = []
+_retrying = {}  # TimerHandle -> item waiting out its backoff
+_held = []  # items a worker was delivering when stop() cancelled it
+_counters = {'queued': 0, 'sent': 0, 'retried': 0, 'dead_lettered': 0}
+
+
+def send(bot, chat_id, text, **kwargs):
+    """Queue a send_message call; returns immediately and delivers in the background."""
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue()
+    if not _workers:
+        _workers.extend(asyncio.create_task(_worker(bot)) for _ in range(WORKERS))
+    _counters['queued'] += 1
+    _queue.put_nowait((chat_id, text, kwargs, 0))
+
+
+def stats():
+    return {**_counters, 'pending': _queue.qsize() if _queue else 0, 'retrying': len(_retrying)}
+
+
+async def stop():
+    """Give queued notifications a moment to go out, then dead-letter whatever is left."""
+    if _queue is not None and _workers:
+        try:
+            await asyncio.wait_for(_drain(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+    for handle in _retrying:
+        handle.cancel()
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    leftovers = [(chat_id, text, kwargs, attempt, "not delivered before shutdown")
+                 for chat_id, text, kwargs, attempt in [*_held, *_retrying.values(), *_drain_nowait()]]
+    _held.clear()
+    _retrying.clear()
+    if leftovers:
+        await _dead_letter(leftovers)
+
+
+async def _drain():
+    while _queue.qsize() or _retrying:
+        await asyncio.sleep(0.1)
+    await _queue.join()
+
+
+def _drain_nowait():
+    items = []
+    while _queue is not None and not _queue.empty():
+        items.append(_queue.get_nowait())
+        _queue.task_done()
+    return items
+
+
+async def _worker(bot):
+    while True:
+        item = await _queue.get()
+        try:
+            await _deliver(bot, *item)
+        except asyncio.CancelledError:
+            _held.append(item)
+            raise
+        except Exception:
+            logger.exception(f"Unexpected error delivering a notification to {item[0]}")
+        finally:
+            _queue.task_done()
+
+
+async def _deliver(bot, chat_id, text, kwargs, attempt):
+    await bot_limiter.wait(chat_id)
+    try:
+        await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        _counters['sent'] += 1
+    except RetryAfter as e:
+        # Flood control isn't the message's fault; requeue without spending an attempt.
+        seconds = retry_after_seconds(e)
+        bot_limiter.retry_after(seconds)
+        _retry_later((chat_id, text, kwargs, attempt), seconds)
+    except (Forbidden, BadRequest) as e:
+        await _dead_letter([(chat_id, text, kwargs, attempt + 1, str(e))])
+    except NetworkError as e:
+        if attempt + 1 >= MAX_ATTEMPTS:
+            await _dead_letter([(chat_id, text, kwargs, attempt + 1, str(e))])
+        else:
+            _retry_later((chat_id, text, kwargs, attempt + 1), min(2 ** attempt, MAX_BACKOFF))
+    except TelegramError as e:
+        await _dead_letter([(chat_id, text, kwargs, attempt + 1, str(e))])
+
+
+def _retry_later(item, delay):
+    _counters['retried'] += 1
+
+    def requeue():
+        _retrying.pop(handle, None)
+        _queue.put_nowait(item)
+
+    handle = asyncio.get_running_loop().call_later(delay, requeue)
+    _retrying[handle] = item
+
+
+async def _dead_letter(items):
+    _counters['dead_lettered'] += len(items)
+    for chat_id, _, _, attempts, error in items:
+        logger.warning(f"Giving up on notification to {chat_id} after {attempts} attempt(s): {error}")
+    try:
+        await db.add_dead_letters([(chat_id, text, json.dumps(_serialise(kwargs)), attempts, error)
+                                   for chat_id, text, kwargs, attempts, error in items])
+    except Exception:
+        logger.exception("Could not record dead-lettered notifications")
+
+
+def _serialise(kwargs):
+    return {k: v.to_dict() if hasattr(v, 'to_dict') else v for k, v in kwargs.items()}
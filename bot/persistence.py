@@ -0,0 +1,152 @@
+# bot/persistence.py
+"""
+Postgres-backed persistence for user_data, chat_data and ConversationHandler
+states.
+
+- user_data/chat_data are loaded lazily, the first time a user or chat shows
+  up after a restart, so startup cost doesn't grow with the user base.
+- Values are stored one row per key. Each persistence run diffs against what
+  was last written and writes only the changed and removed keys, all in one
+  transaction.
+- Conversation states are few (only in-flight conversations have a row), so
+  they are loaded eagerly as ConversationHandler requires.
+"""
+import asyncio
+import json
+import logging
+import os
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from . import database as db
+
+logger = logging.getLogger(__name__)
+
+UPDATE_INTERVAL = float(os.environ.get('PERSISTENCE_INTERVAL', 10))
+
+USER, CHAT = 'u', 'c'
+
+
+class PostgresPersistence(BasePersistence):
+    def __init__(self, update_interval=UPDATE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self._written = {}  # (kind, owner_id) -> {key: json text} as last stored
+        self._loaded = set()
+        self._pending_data = {}  # (kind, owner_id, key) -> json text, or None to delete
+        self._pending_drops = set()  # (kind, owner_id) whose rows should all go
+        self._pending_conversations = {}  # (name, key json) -> state json, or None to delete
+        self._write_task = None
+
+    # --- Loading ---
+    async def get_user_data(self):
+        return {}  # loaded per user in refresh_user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await db.get_conversation_states(name)
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._load(USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._load(CHAT, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def _load(self, kind, owner_id, data):
+        if (kind, owner_id) in self._loaded:
+            return
+        rows = await db.load_persistence_data(kind, owner_id)
+        # Only once the read succeeded; a failed load is retried on the user's next update.
+        self._loaded.add((kind, owner_id))
+        written = self._written.setdefault((kind, owner_id), {})
+        for key, value in rows:
+            written[key] = value
+            data.setdefault(key, json.loads(value))
+
+    # --- Staging writes ---
+    async def update_user_data(self, user_id, data):
+        self._stage(USER, user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage(CHAT, chat_id, data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._drop(USER, user_id)
+
+    async def drop_chat_data(self, chat_id):
+        self._drop(CHAT, chat_id)
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, json.dumps(list(key)))] = None if new_state is None else json.dumps(new_state)
+        self._schedule_write()
+
+    def _stage(self, kind, owner_id, data):
+        written = self._written.setdefault((kind, owner_id), {})
+        current = {}
+        for key, value in data.items():
+            try:
+                current[str(key)] = json.dumps(value, sort_keys=True)
+            except (TypeError, ValueError):
+                logger.warning(f"Not persisting {kind}:{owner_id}:{key}; value is not JSON serialisable")
+        for key, value in current.items():
+            if written.get(key) != value:
+                self._pending_data[(kind, owner_id, key)] = value
+        for key in written.keys() - current.keys():
+            self._pending_data[(kind, owner_id, key)] = None
+        self._written[(kind, owner_id)] = current
+        self._schedule_write()
+
+    def _drop(self, kind, owner_id):
+        self._written.pop((kind, owner_id), None)
+        self._pending_data = {k: v for k, v in self._pending_data.items() if k[:2] != (kind, owner_id)}
+        self._pending_drops.add((kind, owner_id))
+        self._schedule_write()
+
+    def _schedule_write(self):
+        # The Application stages every changed user in one burst; the write runs once they are all in.
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.ensure_future(self._write())
+
+    async def _write(self):
+        await asyncio.sleep(0)
+        if not (self._pending_data or self._pending_drops or self._pending_conversations):
+            return
+        data, drops, conversations = self._pending_data, self._pending_drops, self._pending_conversations
+        self._pending_data, self._pending_drops, self._pending_conversations = {}, set(), {}
+        try:
+            await db.write_persistence_batch(
+                upserts=[(kind, owner, key, value) for (kind, owner, key), value in data.items() if value is not None],
+                deletes=[(kind, owner, key) for (kind, owner, key), value in data.items() if value is None],
+                drops=list(drops),
+                conversation_upserts=[(name, key, state) for (name, key), state in conversations.items() if state is not None],
+                conversation_deletes=[(name, key) for (name, key), state in conversations.items() if state is None],
+            )
+        except Exception:
+            logger.exception("Persistence write failed; will retry with the next batch")
+            # Newer staged values win over the ones we failed to write.
+            self._pending_data = {**data, **self._pending_data}
+            self._pending_drops |= drops
+            self._pending_conversations = {**conversations, **self._pending_conversations}
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        await self._write()
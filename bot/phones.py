@@ -0,0 +1,85 @@
+# bot/phones.py
+"""
+Duplicate-account detection on phone numbers.
+
+Numbers are normalised and stored only as a keyed hash (users.phone_hash,
+unique). An in-process Bloom filter, built from the table at startup and
+updated on every registration, answers "definitely new" for the common case
+so only numbers that may already be registered cost a lookup. The unique
+index stays the source of truth: numbers registered by another process since
+startup are caught by it at insert time.
+
+PHONE_HASH_KEY (any long random string) is required: without it the hash of
+a ~10^8 number space is trivially reversible. It must never change once users
+have registered, since every stored hash is derived from it.
+"""
+import hashlib
+import hmac
+import logging
+import math
+import os
+import re
+
+from . import database as db
+
+logger = logging.getLogger(__name__)
+
+# Keyed so the stored hashes can't be reversed by hashing every possible number;
+# main() refuses to start without it.
+HASH_KEY = os.environ.get('PHONE_HASH_KEY', '').encode()
+BLOOM_CAPACITY = int(os.environ.get('PHONE_BLOOM_CAPACITY', 1_000_000))
+BLOOM_ERROR_RATE = 0.001
+
+
+def normalise(phone_number):
+    """Digits only, without an international '00' prefix: '+251 91-234' -> '25191234'."""
+    digits = re.sub(r'\D', '', phone_number or '')
+    return digits[2:] if digits.startswith('00') else digits
+
+
+def phone_hash(phone_number):
+    return hmac.new(HASH_KEY, normalise(phone_number).encode(), hashlib.sha256).digest()
+
+
+class BloomFilter:
+    """Bit-array Bloom filter over values that are already uniform hashes."""
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, min(8, round(self.size / capacity * math.log(2))))  # 8 x 4-byte slices of a sha256
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        return (int.from_bytes(value[i * 4:i * 4 + 4], 'big') % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+_filter = None
+
+
+async def load():
+    """Rebuild the filter from every stored phone hash."""
+    global _filter
+    registered = await db.count_phone_hashes()
+    bloom = BloomFilter(max(BLOOM_CAPACITY, registered * 2))
+    await db.load_phone_hashes(bloom.add)
+    _filter = bloom
+    logger.info(f"Phone filter loaded with {bloom.count} numbers ({bloom.size // 8 // 1024} KiB)")
+
+
+def maybe_registered(value):
+    # Before load() has run we can't rule anything out.
+    return _filter is None or value in _filter
+
+
+def add(value):
+    if _filter is not None:
+        _filter.add(value)
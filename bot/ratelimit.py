@@ -0,0 +1,84 @@
+# bot/ratelimit.py
+import asyncio
+import os
+import time
+from datetime import timedelta
+
+# Telegram allows roughly 30 messages/second overall and 1 message/second per chat.
+GLOBAL_RATE = float(os.environ.get('BOT_API_RATE', 25))
+PER_CHAT_INTERVAL = float(os.environ.get('BOT_API_PER_CHAT_INTERVAL', 1.0))
+# Worker mode gives each process a share of BOT_API_RATE; broadcasts are leased
+# to one process at a time, so they are allowed the whole budget instead.
+BROADCAST_RATE = float(os.environ.get('BROADCAST_API_RATE', GLOBAL_RATE))
+
+
+def retry_after_seconds(error):
+    """`RetryAfter.retry_after` is an int or a timedelta depending on the library version."""
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+
+class TokenBucket:
+    """Classic token bucket; waiters are served in FIFO order."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds`, e.g. after a 429 RetryAfter."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class RateLimiter:
+    """Global token bucket plus a minimum interval between messages to the same chat."""
+
+    def __init__(self, rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self._next_for_chat = {}
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        ready_at = self._next_for_chat.get(chat_id, 0.0)
+        self._next_for_chat[chat_id] = max(now, ready_at) + self.per_chat_interval
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+        await self.bucket.acquire()
+        if len(self._next_for_chat) > 10000:
+            self._prune()
+
+    def retry_after(self, seconds):
+        self.bucket.pause(seconds)
+
+    def _prune(self):
+        now = time.monotonic()
+        self._next_for_chat = {chat: t for chat, t in self._next_for_chat.items() if t > now}
+
+
+# Shared by everything that sends messages outside a direct reply to an update.
+bot_limiter = RateLimiter()
+# Single-process mode keeps one bucket for everything.
+broadcast_limiter = bot_limiter if BROADCAST_RATE == GLOBAL_RATE else RateLimiter(BROADCAST_RATE)
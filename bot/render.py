@@ -0,0 +1,24 @@
+# bot/render.py
+"""
+Per-user text that is cheap to keep and wasteful to rebuild on every press.
+The bot's username comes from `bot.username`, which PTB fills in once during
+Application.initialize(), so rendering never needs a getMe request.
+"""
+import functools
+import os
+
+CACHE_SIZE = int(os.environ.get('RENDER_CACHE_SIZE', 100000))
+
+
+def referral_link(bot_username, user_id):
+    return f"https://t.me/{bot_username}?start={user_id}"
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def refer_friends_text(bot_username, user_id, bonus):
+    return f"👥 **Refer & Earn**\n\nInvite friends and earn **{bonus} ETB** for each one!\n\nYour link:\n`{referral_link(bot_username, user_id)}`"
+
+
+def cache_stats():
+    info = refer_friends_text.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
@@ -0,0 +1,62 @@
+# bot/stats.py
+"""
+Event counters for the statistics dashboard. Handlers call `record()` as
+things happen; the counts are buffered in memory and folded into the
+stats_hourly/stats_totals tables by a periodic job, so the hot paths never
+touch a shared counter row and the dashboard never scans the base tables.
+"""
+import logging
+import os
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from . import database as db
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = int(os.environ.get('STATS_FLUSH_INTERVAL', 60))
+
+_pending = Counter()  # (hour, metric, dim) -> delta not yet written
+
+
+def _current_hour():
+    return datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def record(metric, dim='', value=1):
+    _pending[(_current_hour(), metric, dim)] += value
+
+
+async def flush():
+    global _pending
+    if not _pending:
+        return
+    batch, _pending = _pending, Counter()
+    try:
+        await db.add_stats(list(batch.items()))
+    except BaseException:
+        _pending.update(batch)  # keep the counts for the next attempt
+        raise
+
+
+async def flush_job(context):
+    try:
+        await flush()
+    except Exception:
+        logger.exception("Could not flush statistics")
+
+
+async def snapshot(hours=24):
+    """
+    Totals keyed by (metric, dim) and hourly values keyed by (hour, metric, dim)
+    for the last `hours` hours, including counts not yet flushed.
+    """
+    since = _current_hour() - timedelta(hours=hours - 1)
+    total_rows, hourly_rows = await db.get_stats(since)
+    totals = Counter({(metric, dim): value for metric, dim, value in total_rows})
+    hourly = Counter({(hour, metric, dim): value for hour, metric, dim, value in hourly_rows})
+    for (hour, metric, dim), value in _pending.items():
+        totals[(metric, dim)] += value
+        if hour >= since:
+            hourly[(hour, metric, dim)] += value
+    return totals, hourly, since
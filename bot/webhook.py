@@ -0,0 +1,105 @@
+# bot/webhook.py
+"""
+Webhook serving mode. Telegram (or a load balancer in front of several bot
+instances) POSTs updates to WEBHOOK_PATH; each request must carry the
+X-Telegram-Bot-Api-Secret-Token header matching WEBHOOK_SECRET.
+
+To test locally, leave WEBHOOK_URL unset (so no setWebhook call is made) and
+POST a recorded update:
+
+    curl -X POST http://localhost:8443/telegram \\
+         -H 'X-Telegram-Bot-Api-Secret-Token: <WEBHOOK_SECRET>' \\
+         -H 'Content-Type: application/json' -d @update.json
+"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler
+
+from . import httpd, lifecycle
+
+logger = logging.getLogger(__name__)
+
+LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+PATH = '/' + os.environ.get('WEBHOOK_PATH', 'telegram').strip('/')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # public URL Telegram should call; unset for local testing
+SECRET = os.environ.get('WEBHOOK_SECRET')
+
+# The handlers only read update.message / update.callback_query.
+_UPDATE_TYPES = {
+    CommandHandler: Update.MESSAGE,
+    MessageHandler: Update.MESSAGE,
+    CallbackQueryHandler: Update.CALLBACK_QUERY,
+}
+
+
+def allowed_update_types(application):
+    """The update types the registered handlers can actually consume."""
+    types = set()
+    for handler in lifecycle.iter_handlers(application):
+        for handler_type, update_type in _UPDATE_TYPES.items():
+            if isinstance(handler, handler_type):
+                types.add(update_type)
+    return sorted(types)
+
+
+def request_handler(deliver):
+    """
+    httpd handler that authenticates webhook POSTs and passes each decoded
+    update dict to `await deliver(data)`.
+    """
+    async def handle(method, path, headers, body):
+        if path == '/healthz' and method == 'GET':
+            return 200, b'ok', 'text/plain'
+        if path != PATH:
+            return 404, b'not found', 'text/plain'
+        if method != 'POST':
+            return 405, b'method not allowed', 'text/plain'
+        # Header values arrive latin-1 decoded; compare bytes so non-ASCII input is a mismatch, not a TypeError.
+        token = headers.get('x-telegram-bot-api-secret-token', '').encode('latin-1')
+        if not hmac.compare_digest(token, SECRET.encode()):
+            return 403, b'forbidden', 'text/plain'
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError("update is not a JSON object")
+            await deliver(data)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Rejected malformed webhook body: {e}")
+            return 400, b'bad update', 'text/plain'
+        return 200, b'', 'text/plain'
+    return handle
+
+
+async def _serve(application, allowed_updates):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def deliver(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    async with lifecycle.running(application):
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(WEBHOOK_URL.rstrip('/') + PATH, secret_token=SECRET, allowed_updates=allowed_updates)
+        server = await httpd.serve(request_handler(deliver), LISTEN, PORT)
+        logger.info(f"Webhook listening on {LISTEN}:{PORT}{PATH} for {', '.join(allowed_updates)}")
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+
+def run(application, allowed_updates):
+    """Serve updates over HTTP until SIGINT/SIGTERM."""
+    if not SECRET:
+        raise ValueError("WEBHOOK_SECRET must be set in webhook mode")
+    asyncio.run(_serve(application, allowed_updates))
@@ -0,0 +1,195 @@
+# bot/workers.py
+"""
+Multi-process mode: one ingress process receives updates (long polling or
+webhook) and hands each one, still as a plain dict, to one of N worker
+processes that run the full Application. Updates are routed by user id (or
+chat id when there is no user), so a user's conversation state, per-user
+ordering and caches all live on a single worker.
+
+Work shared between workers is coordinated through Postgres:
+
+- broadcasts are leased to one process at a time (bot.broadcast),
+- the balance ledger flush takes an advisory lock (database.flush_ledger),
+- statistics counters are per-process deltas, so every worker flushes its own.
+
+The Bot API rate budget (BOT_API_RATE) is split evenly between workers, except
+that the worker holding a broadcast's lease sends it at the full rate, and
+each worker exposes metrics on METRICS_PORT + 1 + its index. The read caches
+are per process; the values they can miss are credits made by other workers,
+so a cached balance may lag (never lead) by up to DB_CACHE_TTL.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+
+import httpx
+from telegram import Update
+
+from . import httpd, lifecycle, ratelimit, webhook
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 30
+QUEUE_SIZE = int(os.environ.get('WORKER_QUEUE_SIZE', 10000))  # updates buffered per worker
+SUPERVISE_INTERVAL = 5  # seconds between checks for dead workers
+
+
+def route_key(data):
+    """Mirror of concurrency.ordering_key for a raw update dict."""
+    for key, value in data.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        for field in ('from', 'user'):
+            if isinstance(value.get(field), dict):
+                return value[field]['id']
+        if isinstance(value.get('chat'), dict):
+            return value['chat']['id']
+    return data.get('update_id', 0)
+
+
+# --- Worker side ---
+def _worker_main(build_application, token, index, updates):
+    # The ingress owns shutdown; a terminal's Ctrl-C must not kill workers mid-update.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger(__name__).info(f"Worker {index} starting (pid {os.getpid()})")
+    asyncio.run(_work(build_application(token), updates))
+
+
+async def _work(application, updates):
+    loop = asyncio.get_running_loop()
+    async with lifecycle.running(application):
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            try:
+                update = Update.de_json(data, application.bot)
+            except (ValueError, TypeError, KeyError) as e:
+                logger.warning(f"Dropped malformed update {data.get('update_id')}: {e}")
+                continue
+            await application.update_queue.put(update)
+
+
+# --- Ingress side ---
+class _Pool:
+    def __init__(self, build_application, token, count):
+        self.build_application, self.token, self.count = build_application, token, count
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue(QUEUE_SIZE) for _ in range(count)]
+        self.processes = [None] * count
+        self.stopping = False
+
+    def start(self, index):
+        # Spawned children read their configuration from the environment at import time.
+        overrides = {'BOT_API_RATE': str(ratelimit.GLOBAL_RATE / self.count),
+                     'BROADCAST_API_RATE': str(ratelimit.BROADCAST_RATE)}
+        if os.environ.get('METRICS_PORT'):
+            overrides['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + 1 + index)
+        saved = {name: os.environ.get(name) for name in overrides}
+        os.environ.update(overrides)
+        try:
+            process = self.context.Process(target=_worker_main, name=f'bot-worker-{index}',
+                                           args=(self.build_application, self.token, index, self.queues[index]))
+            process.start()
+        finally:
+            for name, value in saved.items():
+                if value is None: os.environ.pop(name, None)
+                else: os.environ[name] = value
+        self.processes[index] = process
+
+    async def deliver(self, data):
+        target = self.queues[route_key(data) % self.count]
+        try:
+            target.put_nowait(data)
+        except queue.Full:
+            # Backpressure: wait for the worker rather than dropping its user's update.
+            await asyncio.get_running_loop().run_in_executor(None, target.put, data)
+
+    async def supervise(self):
+        while not self.stopping:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if not self.stopping and not process.is_alive():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}; restarting it")
+                    self.start(index)
+
+    async def stop(self, timeout=30):
+        self.stopping = True
+        loop = asyncio.get_running_loop()
+        for updates in self.queues:
+            await loop.run_in_executor(None, updates.put, None)
+        for index, process in enumerate(self.processes):
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop in {timeout}s; terminating it")
+                process.terminate()
+
+
+async def _poll(client, api, allowed_updates, deliver):
+    await client.post(f"{api}/deleteWebhook")
+    offset, failures = None, 0
+    while True:
+        try:
+            response = await client.post(f"{api}/getUpdates",
+                                         json={'offset': offset, 'timeout': POLL_TIMEOUT, 'allowed_updates': allowed_updates})
+            payload = response.json()
+            if not payload.get('ok'):
+                raise RuntimeError(payload.get('description'))
+        except (httpx.HTTPError, ValueError, RuntimeError) as e:
+            failures += 1
+            logger.warning(f"getUpdates failed ({e}); retrying")
+            await asyncio.sleep(min(2 ** failures, 30))
+            continue
+        failures = 0
+        for data in payload['result']:
+            await deliver(data)
+            offset = data['update_id'] + 1
+
+
+async def _serve(build_application, token, count, mode, allowed_updates):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    workers = _Pool(build_application, token, count)
+    for index in range(count):
+        workers.start(index)
+    supervisor = asyncio.create_task(workers.supervise())
+    api = f"https://api.telegram.org/bot{token}"
+    async with httpx.AsyncClient(timeout=POLL_TIMEOUT + 10) as client:
+        if mode == 'webhook':
+            if webhook.WEBHOOK_URL:
+                await client.post(f"{api}/setWebhook", json={'url': webhook.WEBHOOK_URL.rstrip('/') + webhook.PATH,
+                                                              'secret_token': webhook.SECRET, 'allowed_updates': allowed_updates})
+            server = await httpd.serve(webhook.request_handler(workers.deliver), webhook.LISTEN, webhook.PORT)
+            logger.info(f"Ingress listening on {webhook.LISTEN}:{webhook.PORT}{webhook.PATH} for {count} workers")
+            receiver = None
+        else:
+            server = None
+            receiver = asyncio.create_task(_poll(client, api, allowed_updates, workers.deliver))
+            logger.info(f"Ingress polling for {count} workers")
+        try:
+            await stop.wait()
+        finally:
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+            if receiver is not None:
+                receiver.cancel()
+                await asyncio.gather(receiver, return_exceptions=True)
+            supervisor.cancel()
+            await workers.stop()
+
+
+def run(build_application, token, count, mode, allowed_updates):
+    """
+    Run `count` worker processes, each with its own `build_application(token)`,
+    behind one ingress until SIGINT/SIGTERM.
+    """
+    if mode == 'webhook' and not webhook.SECRET:
+        raise ValueError("WEBHOOK_SECRET must be set in webhook mode")
+    asyncio.run(_serve(build_application, token, count, mode, allowed_updates))
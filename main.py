@@ -1,7 +1,7 @@
 # main.py
+import argparse
 import os
 from dotenv import load_dotenv
-from telegram import Update
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -10,19 +10,43 @@ from telegram.ext import (
     filters,
     ConversationHandler,
 )
-from bot import handlers, database
+from bot import broadcast, concurrency, handlers, database, metrics, notify, persistence, phones, stats, webhook, workers
 
 load_dotenv()
 
-def main():
-    """Run the bot."""
-    database.setup_database()
-    
-    TOKEN = os.environ.get("BOT_TOKEN")
-    if not TOKEN:
-        raise ValueError("No BOT_TOKEN found in environment variables")
+async def post_init(application: Application):
+    await phones.load()
+    application.job_queue.run_repeating(stats.flush_job, interval=stats.FLUSH_INTERVAL, first=stats.FLUSH_INTERVAL)
+    application.job_queue.run_repeating(handlers.ledger_flush_job, interval=handlers.LEDGER_FLUSH_INTERVAL, first=handlers.LEDGER_FLUSH_INTERVAL)
+    if metrics.ENABLED:
+        await metrics.start(application)
+    await broadcast.resume_unfinished(application.bot)
+    application.job_queue.run_repeating(broadcast.claim_job, interval=broadcast.LEASE_SECONDS / 2, first=broadcast.LEASE_SECONDS / 2)
+
+async def post_stop(application: Application):
+    await broadcast.stop_all()
+    await handlers.flush_ledger(application.bot)
+    await notify.stop()
+    await stats.flush()
+    await metrics.stop()
 
-    application = Application.builder().token(TOKEN).build()
+async def post_shutdown(application: Application):
+    database.close_pool()
+
+def build_application(token):
+    """Create the Application with every handler registered."""
+    builder = Application.builder().token(token)
+    if metrics.ENABLED:
+        builder = builder.request(metrics.InstrumentedRequest(connection_pool_size=256))
+    application = (
+        builder
+        .concurrent_updates(concurrency.PerUserUpdateProcessor(concurrency.UPDATE_CONCURRENCY))
+        .persistence(persistence.PostgresPersistence())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # --- Conversation Handler for Withdrawal ---
     withdrawal_handler = ConversationHandler(
@@ -42,6 +66,8 @@ def main():
             CommandHandler('cancel', handlers.cancel_conversation),
             CallbackQueryHandler(handlers.show_main_menu, pattern='^main_menu$'),
         ],
+        name='withdrawal',
+        persistent=True,
     )
     
     # --- Conversation Handler for Admin Broadcast ---
@@ -56,12 +82,15 @@ def main():
             ],
         },
         fallbacks=[CommandHandler('cancel', handlers.cancel_conversation)],
+        name='broadcast',
+        persistent=True,
     )
 
     # --- Add all handlers ---
     # Top-level commands
     application.add_handler(CommandHandler("start", handlers.start))
     application.add_handler(CommandHandler("admin", handlers.admin_command))
+    application.add_handler(CommandHandler("export", handlers.export_command))
     application.add_handler(CommandHandler("myid", handlers.my_id_command)) # ADD THIS LINE
     
     # Registration Flow
@@ -75,8 +104,39 @@ def main():
     # This handler routes all other button clicks.
     application.add_handler(CallbackQueryHandler(handlers.button_handler))
 
-    print("Bot is starting... Final version with Admin Panel fix.")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if metrics.ENABLED:
+        metrics.install(application)
+    return application
+
+def main():
+    """Run the bot."""
+    parser = argparse.ArgumentParser(description="Run the referral bot.")
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default=os.environ.get('BOT_MODE', 'polling'),
+                        help="how to receive updates (default: $BOT_MODE or polling)")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('BOT_WORKERS', 0)),
+                        help="run handlers in this many worker processes behind one ingress (default: $BOT_WORKERS or 0, single process)")
+    args = parser.parse_args()
+
+    database.init_pool()
+    database.setup_database()
+    
+    TOKEN = os.environ.get("BOT_TOKEN")
+    if not TOKEN:
+        raise ValueError("No BOT_TOKEN found in environment variables")
+    if not phones.HASH_KEY:
+        raise ValueError("No PHONE_HASH_KEY found in environment variables")
+
+    application = build_application(TOKEN)
+    allowed_updates = webhook.allowed_update_types(application)
+
+    print(f"Bot is starting in {args.mode} mode" + (f" with {args.workers} workers..." if args.workers else "..."))
+    if args.workers:
+        database.close_pool()  # each worker opens its own
+        workers.run(build_application, TOKEN, args.workers, args.mode, allowed_updates)
+    elif args.mode == 'webhook':
+        webhook.run(application, allowed_updates)
+    else:
+        application.run_polling(allowed_updates=allowed_updates)
 
 if __name__ == "__main__":
     main()